@@ -9,7 +9,19 @@ import re
 import pytz
 import time
 import concurrent.futures 
+import hashlib
+import numpy as np
+import random
+import threading
+from collections import Counter, deque
 from dotenv import load_dotenv
+from PIL import Image
+
+# مكتبة PyMuPDF اختيارية: تُستخدم لعرض صفحات PDF وقراءة طبقة النص لكشف المستندات المكررة
+try:
+    import fitz
+except ImportError:
+    fitz = None
 
 # استيراد مكتبات Gemini
 from google import genai
@@ -17,13 +29,21 @@ from google.genai.errors import APIError as GeminiAPIError
 
 # محاولة استيراد الدوال من db.py (يجب أن يكون ملف db.py موجوداً بجانبه)
 try:
-    from db import save_to_db, fetch_all_reports, initialize_db
+    from db import (
+        save_to_db, fetch_all_reports, initialize_db,
+        save_document_fingerprint, fetch_fingerprint_candidates,
+        fetch_related_reports, rebuild_entity_index
+    )
 except ImportError:
     st.error("❌ فشل استيراد db.py. تأكد من وجود الملف وأن الدوال (save_to_db, fetch_all_reports, initialize_db) معرفة فيه.")
     # تعريف الدوال فارغة لتجنب الانهيار إذا كان الملف مفقودًا
     def save_to_db(*args): st.error("❌ DB function missing.")
     def fetch_all_reports(): return None, None
     def initialize_db(): pass
+    def save_document_fingerprint(*args): return False
+    def fetch_fingerprint_candidates(*args): return {}
+    def fetch_related_reports(*args, **kwargs): return None, None, None
+    def rebuild_entity_index(*args): return False
 
 # ===============================
 # 1. إعدادات API 
@@ -31,10 +51,14 @@ except ImportError:
 load_dotenv()
 
 MODEL_NAME = os.getenv("MODEL_NAME", 'gemini-2.5-flash') 
+# المهلة القصوى لكل استدعاء API بالثواني
+GEMINI_CALL_TIMEOUT_SECONDS = float(os.getenv("GEMINI_CALL_TIMEOUT_SECONDS", "180"))
 
 # تهيئة العميل 
 try:
-    client = genai.Client()
+    client = genai.Client(
+        http_options=genai.types.HttpOptions(timeout=int(GEMINI_CALL_TIMEOUT_SECONDS * 1000))
+    )
 except Exception as e:
     st.error(f"❌ خطأ في تهيئة Gemini Client: {e}")
     client = None
@@ -69,18 +93,8 @@ DELALAT_MAPPING = {
 # =================================================================================
 # التعديل الرئيسي: إضافة مخطط JSON صريح وتخفيف قيود API
 # =================================================================================
-SYSTEM_PROMPT = (
-    "أنت نظام استخلاص بيانات آلي (Gemini API) فائق الدقة. مهمتك هي قراءة الوثيقة المرفقة (PDF/صورة) "
-    "واستخلاص جميع البيانات وتحويلها إلى كائن JSON وفقاً للحقول المطلوبة أدناه، **ويجب إخراج قيمة لكل حقل.** "
-    
-    "**تعليمات الاستخلاص لضمان استخراج كل الحقول (أولوية قصوى):** "
-    "1. **التجميع من كل مكان:** يجب البحث عن قيمة لكل حقل عبر قراءة **الوثيقة بالكامل (في جميع صفحاتها)** بما في ذلك الجداول، العناوين، وجميع النصوص. لا تفترض أن البيانات في مكان واحد. "
-    "2. **البيانات الأساسية:** يجب استخلاص قيم حقول 'اسم المشتبه به'، 'رقم الهوية'، 'رقم الصادر'، 'رقم الوارد'، و 'سبب الاشتباه' بشكل إجباري إن وجدت. "
-    "3. **التواريخ والأرقام:** يجب تحويل جميع التواريخ إلى صيغة رقمية موحدة 'YYYY/MM/DD' وتحويل الأرقام العربية إلى إنجليزية. "
-    "4. **الاستخلاص الحرفي لـ 'سبب الاشتباه':** يجب نسخ النص الكامل لـ 'سبب الاشتباه' حرفيًا دون تلخيص أو تحريف أو حذف. هذه هي أهم قيمة. "
-    "5. **استخدام 'غير متوفر':** **يجب الامتناع عن استخدام 'غير متوفر' إلا إذا كنت متأكداً بنسبة 100% أن الحقل غير مذكور في أي مكان بالوثيقة.** "
-    "6. **حقل الهوية والسجل:** 'رقم الهوية' هو هوية الفرد (المواطن/المقيم)، و 'رقم صاحب العمل/السجل التجاري' هو رقم السجل التجاري للكيان. "
-    
+# تعليمات اختيار رقم الدلالة وقائمة الدلالات (تُستخدم في التعليمات الكاملة وفي طلبات الاستكمال)
+DELALAT_RULES_PROMPT = (
     "**تعليمات تحديد 'رقم الدلالة' (مهمة عالية الدقة):** "
     "1. **اقرأ حقل 'سبب الاشتباه'** كاملاً. "
     "2. **حدد طبيعة المشتبه به:** هل هو **فرد/وافد** (بمجرد ذكر 'الوافد' أو 'الإقامة') أو **كيان تجاري** (بمجرد ذكر 'سجل تجاري' أو 'مؤسسة' أو 'تموينات'). "
@@ -88,7 +102,9 @@ SYSTEM_PROMPT = (
     "   - **إذا كان المشتبه به 'فرد/وافد'،** **يُمنع** اختيار الدلالات (8، 9، 10، 11) لأنها خاصة بالكيانات. اختر فقط من (1، 2، 3، 4، 5، 6، 7). "
     "   - **إذا كان المشتبه به 'كيان تجاري'،** **يُمنع** اختيار الدلالات (1، 3، 5، 6، 7) لأنها خاصة بالأفراد. اختر فقط من (2، 4، 8، 9، 10، 11). "
     "4. **اختر رقم الدلالة الأنسب** الذي يعكس محتوى 'سبب الاشتباه'. إذا انطبق أكثر من رقم، ضعهما مفصولين بفاصلة فقط (مثال: 8,11). يجب أن تكون القيمة المستخلصة هي **الرقم فقط** (مثال: 1 أو 8 أو 8,11). "
-    
+)
+
+DELALAT_PROMPT_LIST = (
     "**قائمة الدلالات:**\n"
     "1: تكرار العمليات المالية (إيداعات، حوالات سحوبات مشتريات) في حساب المقيم لا تتناسب مع دخله السنوي. \n"
     "2: تحويلات أو إيداعات نقدية من حساب عميل مقيم الى حساب فرد سعودي أو كيان تجاري. \n"
@@ -101,10 +117,20 @@ SYSTEM_PROMPT = (
     "9: حوالات دولية واردة أو صادرة لحساب الكيان التجاري لا تتناسب مع نشاط الكيان التجاري. \n"
     "10: تفويض أجنبي على حساب بنكي عائد لكيان تجاري وتمكينه من الحساب بشكل كامل دون وجود مبرر أو غرض واضح. \n"
     "11: فتح عدة حسابات الفروع كيان تجاري لنفس النشاط دون وجود ارتباط واضح بين هذه الحسابات، نظراً لإدارة الحساب الخاص بالفرع من قبل المقيم. \n"
+)
 
-    "**المخرج المطلوب (Output Format):** "
-    "يجب أن تكون الإجابة الوحيدة هي كائن JSON، محاطة بـ \`\`\`json و \`\`\`، ويجب أن تحتوي على جميع المفاتيح التالية (حتى لو كانت القيمة 'غير متوفر'). يجب استبدال 'القيمة' بالقيمة المستخلصة من المستند:"
-    "\n\n```json\n"
+# قواعد الاستخلاص العامة وقالب الحقول (مشتركة بين تعليمات المستند الواحد وتعليمات الحزم)
+EXTRACTION_RULES_PROMPT = (
+    "**تعليمات الاستخلاص لضمان استخراج كل الحقول (أولوية قصوى):** "
+    "1. **التجميع من كل مكان:** يجب البحث عن قيمة لكل حقل عبر قراءة **الوثيقة بالكامل (في جميع صفحاتها)** بما في ذلك الجداول، العناوين، وجميع النصوص. لا تفترض أن البيانات في مكان واحد. "
+    "2. **البيانات الأساسية:** يجب استخلاص قيم حقول 'اسم المشتبه به'، 'رقم الهوية'، 'رقم الصادر'، 'رقم الوارد'، و 'سبب الاشتباه' بشكل إجباري إن وجدت. "
+    "3. **التواريخ والأرقام:** يجب تحويل جميع التواريخ إلى صيغة رقمية موحدة 'YYYY/MM/DD' وتحويل الأرقام العربية إلى إنجليزية. "
+    "4. **الاستخلاص الحرفي لـ 'سبب الاشتباه':** يجب نسخ النص الكامل لـ 'سبب الاشتباه' حرفيًا دون تلخيص أو تحريف أو حذف. هذه هي أهم قيمة. "
+    "5. **استخدام 'غير متوفر':** **يجب الامتناع عن استخدام 'غير متوفر' إلا إذا كنت متأكداً بنسبة 100% أن الحقل غير مذكور في أي مكان بالوثيقة.** "
+    "6. **حقل الهوية والسجل:** 'رقم الهوية' هو هوية الفرد (المواطن/المقيم)، و 'رقم صاحب العمل/السجل التجاري' هو رقم السجل التجاري للكيان. "
+)
+
+FIELDS_JSON_TEMPLATE = (
     "{\n"
     '"رقم الصادر": "القيمة", "تاريخ الصادر": "القيمة", "اسم المشتبه به": "القيمة", "رقم الهوية": "القيمة",\n'
     '"الجنسية": "القيمة", "تاريخ الميلاد الوافد": "القيمة", "تاريخ الدخول": "القيمة", "الحالة الاجتماعية": "القيمة",\n'
@@ -112,8 +138,16 @@ SYSTEM_PROMPT = (
     '"رقم الوارد": "القيمة", "تاريخ الوارد": "القيمة", "رقم صاحب العمل/ السجل التجاري": "القيمة",\n'
     '"سبب الاشتباه": "القيمة (النص الكامل)", "تاريخ الدارسة من": "القيمة", "تاريخ الدراسة الى": "القيمة",\n'
     '"إجمالي إيداع الدراسة": "القيمة", "رقم الدلالة": "القيمة (رقم فقط)"\n'
-    "}\n"
-    "```"
+    "}"
+)
+
+SYSTEM_PROMPT = (
+    "أنت نظام استخلاص بيانات آلي (Gemini API) فائق الدقة. مهمتك هي قراءة الوثيقة المرفقة (PDF/صورة) "
+    "واستخلاص جميع البيانات وتحويلها إلى كائن JSON وفقاً للحقول المطلوبة أدناه، **ويجب إخراج قيمة لكل حقل.** "
+) + EXTRACTION_RULES_PROMPT + DELALAT_RULES_PROMPT + DELALAT_PROMPT_LIST + (
+    "**المخرج المطلوب (Output Format):** "
+    "يجب أن تكون الإجابة الوحيدة هي كائن JSON، محاطة بـ \\`\\`\\`json و \\`\\`\\`، ويجب أن تحتوي على جميع المفاتيح التالية (حتى لو كانت القيمة 'غير متوفر'). يجب استبدال 'القيمة' بالقيمة المستخلصة من المستند:"
+    "\n\n```json\n" + FIELDS_JSON_TEMPLATE + "\n```"
 )
 # =================================================================================
 # نهاية تعليمات النظام
@@ -174,18 +208,408 @@ def check_for_suspicion(data):
             suspicion_indicator += f"⚠️ ({field} = 0/غير متوفر) "
     return suspicion_indicator.strip() or "✅ سليم"
 
+# الدلالات الخاصة بكل نوع (مطابقة لقواعد المنع في DELALAT_RULES_PROMPT)
+INDIVIDUAL_ONLY_DELALAT = {1, 3, 5, 6, 7}
+ENTITY_ONLY_DELALAT = {8, 9, 10, 11}
+ENTITY_KEYWORDS = ['سجل تجاري', 'السجل التجاري', 'مؤسسة', 'تموينات']
+INDIVIDUAL_KEYWORDS = ['الوافد', 'الإقامة']
+
+def infer_suspect_type(reason_text):
+    """
+    تحديد طبيعة المشتبه به من نص 'سبب الاشتباه': 'كيان' أو 'فرد' أو None إذا تعذر التحديد.
+    النص الذي يذكر النوعين معاً (مثل وافد يعمل لدى مؤسسة) يُعد غير محدد، فلا تُرفض بسببه دلالة أو حقول.
+    """
+    reason_text = str(reason_text or "")
+    is_entity = any(keyword in reason_text for keyword in ENTITY_KEYWORDS)
+    is_individual = any(keyword in reason_text for keyword in INDIVIDUAL_KEYWORDS)
+    if is_entity and not is_individual:
+        return 'كيان'
+    if is_individual and not is_entity:
+        return 'فرد'
+    return None
+
+def is_valid_delala(delala_value, reason_text=""):
+    """التحقق من أن 'رقم الدلالة' أرقام صحيحة ضمن القائمة ولا تخالف قواعد نوع المشتبه به."""
+    delala_str = arabic_to_english_numbers(str(delala_value or "")).strip()
+    if delala_str in ['', 'غير متوفر', 'nan']:
+        return False
+    try:
+        numbers = {int(item.strip()) for item in delala_str.split(',') if item.strip()}
+    except ValueError:
+        return False
+    if not numbers or not numbers.issubset(DELALAT_MAPPING.keys()):
+        return False
+
+    suspect_type = infer_suspect_type(reason_text)
+    if suspect_type == 'فرد' and numbers & ENTITY_ONLY_DELALAT:
+        return False
+    if suspect_type == 'كيان' and numbers & INDIVIDUAL_ONLY_DELALAT:
+        return False
+    return True
+
+# حقول لا تنطبق على نوع المشتبه به، فوجودها بقيمة 'غير متوفر' لا يُعد نقصاً
+ENTITY_INAPPLICABLE_FIELDS = {"تاريخ الميلاد الوافد", "تاريخ الدخول", "الحالة الاجتماعية"}
+INDIVIDUAL_INAPPLICABLE_FIELDS = {"رقم صاحب العمل/ السجل التجاري"}
+
+def detect_extraction_gaps(data):
+    """
+    إرجاع قائمة الحقول الناقصة ('غير متوفر' أو فارغة) أو غير الصالحة في نتيجة الاستخلاص،
+    مع استبعاد الحقول التي لا تنطبق على نوع المشتبه به (أو على أي نوع إذا تعذر تحديده).
+    """
+    suspect_type = infer_suspect_type(data.get("سبب الاشتباه", ""))
+    if suspect_type == 'كيان':
+        inapplicable = ENTITY_INAPPLICABLE_FIELDS
+    elif suspect_type == 'فرد':
+        inapplicable = INDIVIDUAL_INAPPLICABLE_FIELDS
+    else:
+        inapplicable = ENTITY_INAPPLICABLE_FIELDS | INDIVIDUAL_INAPPLICABLE_FIELDS
+
+    gaps = []
+    for fld in REPORT_FIELDS_ARABIC:
+        if fld in inapplicable:
+            continue
+        value = str(data.get(fld, "") or "").strip()
+        if value in ['', 'غير متوفر', 'nan']:
+            gaps.append(fld)
+        elif fld == "رقم الدلالة" and not is_valid_delala(value, data.get("سبب الاشتباه", "")):
+            gaps.append(fld)
+    return gaps
+
 # ===============================
-# 3. دالة الاستخلاص عبر Gemini API
+# 3. استدعاء Gemini بمهلة زمنية وطلبات احتياطية (Hedging) وقاطع دائرة وبث تدريجي
 # ===============================
-def extract_financial_data(file_bytes, file_name, file_type):
-    """يستدعي Gemini API ليُرجع JSON مطابق للمخطط."""
-    if not client:
-        return None
+# HEDGE_PERCENTILE: بعد تجاوز هذه النسبة المئوية من أزمنة الاستجابة المرصودة يُرسل طلب مكرر،
+# و HEDGE_BUDGET_RATIO: الحد الأقصى لنسبة الطلبات المكررة إلى الطلبات الأصلية
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "90"))
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "10"))
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", "45"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "60"))
+# شرائح عدد الصفحات لفئات زمن الاستجابة: الطلب يُقارن فقط بطلبات من نفس النوع والحجم
+LATENCY_PAGE_BUCKETS = (1, 5, 10, 20)
 
-    MAX_RETRIES = 3
-    INITIAL_WAIT_SECONDS = 5
-    
-    # تحديد نوع MIME الصحيح للملف
+
+class CircuitOpenError(RuntimeError):
+    """يُرفع عند إيقاف الإرسال مؤقتاً بسبب تكرار فشل Gemini API."""
+
+
+class LatencyTracker:
+    """نافذة منزلقة لأزمنة الاستجابة الناجحة لحساب النسب المئوية (p50/p90/p99)."""
+
+    def __init__(self, window=500):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def count(self):
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class CircuitBreaker:
+    """يوقف الإرسال بعد عدد من حالات الفشل المتتالية، ثم يسمح بطلب تجريبي واحد بعد فترة التهدئة."""
+
+    def __init__(self, failure_threshold, cooldown_seconds):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown_seconds or self._probe_in_flight:
+                return False
+            # حالة نصف مفتوحة: طلب تجريبي واحد
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probe_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """إنهاء الطلب التجريبي دون تغيير حالة القاطع (خطأ لا يدل على تعطل الخدمة)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+def _is_service_failure(exc):
+    """
+    هل يدل الخطأ على تعطل الخدمة نفسها؟ انتهاء المهلة و 429 و 5xx فقط. أخطاء الطلب (400 وغيرها)
+    سببها المستند أو الطلب، ولا يجب أن توقف الإرسال لجميع الجلسات.
+    """
+    if isinstance(exc, (TimeoutError, concurrent.futures.TimeoutError)) or 'Timeout' in type(exc).__name__:
+        return True
+    if isinstance(exc, GeminiAPIError):
+        code = getattr(exc, 'code', None)
+        return isinstance(code, int) and (code == 429 or code >= 500)
+    return False
+
+
+def latency_class(kind, pages=1):
+    """
+    فئة زمن الاستجابة لطلب: نوعه (ملف، حزمة، استكمال، بث) وشريحة عدد صفحاته.
+    مهلة الطلب المكرر تُحسب داخل الفئة، فلا يبدو جزء PDF من 10 صفحات متأخراً مقارنة بصورة واحدة.
+    """
+    for limit in LATENCY_PAGE_BUCKETS:
+        if pages <= limit:
+            return f"{kind}:{limit}"
+    return f"{kind}:>{LATENCY_PAGE_BUCKETS[-1]}"
+
+
+class GeminiCallGuard:
+    """الحالة المشتركة بين جميع الجلسات: أزمنة الاستجابة، قاطع الدائرة، ميزانية الطلبات المكررة."""
+
+    def __init__(self):
+        # latency لجميع الطلبات (للعرض)، و class_latency لكل فئة طلب (لحساب مهلة الطلب المكرر)
+        self.latency = LatencyTracker()
+        self._class_latency = {}
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN_SECONDS)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=64, thread_name_prefix="gemini-call")
+        self._calls = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self._calls += 1
+
+    def try_acquire_hedge(self):
+        """السماح بطلب مكرر فقط ضمن ميزانية HEDGE_BUDGET_RATIO من إجمالي الطلبات."""
+        with self._lock:
+            if self._hedges + 1 > HEDGE_BUDGET_RATIO * self._calls:
+                return False
+            self._hedges += 1
+            return True
+
+    def class_latency(self, call_class):
+        with self._lock:
+            return self._class_latency.setdefault(call_class, LatencyTracker())
+
+    def record_latency(self, seconds, call_class):
+        self.latency.record(seconds)
+        self.class_latency(call_class).record(seconds)
+
+    def hedge_delay(self, call_class):
+        """
+        مهلة الانتظار قبل إرسال الطلب المكرر: النسبة المئوية المرصودة لأزمنة الاستجابة
+        ضمن فئة الطلب نفسها (أو المهلة الافتراضية قبل توفر عينات كافية منها).
+        """
+        tracker = self.class_latency(call_class)
+        if tracker.count() < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        return tracker.percentile(HEDGE_PERCENTILE)
+
+
+# زمن آخر استدعاء ناجح في الخيط الحالي (يقرؤه run_extraction_unit لتحديث نموذج التكلفة)
+_call_stats = threading.local()
+
+
+@st.cache_resource
+def get_call_guard():
+    """نسخة واحدة من GeminiCallGuard تبقى عبر إعادة تشغيل السكربت وتُشارك بين الجلسات."""
+    return GeminiCallGuard()
+
+
+def generate_content_guarded(contents, config=None, call_class="file:1"):
+    """
+    استدعاء client.models.generate_content بمهلة قصوى GEMINI_CALL_TIMEOUT_SECONDS،
+    مع إرسال طلب مكرر عند التأخر (ضمن الميزانية) واستخدام أول استجابة ناجحة.
+    call_class (من latency_class) تحدد أزمنة الاستجابة التي يُقارن بها الطلب.
+    يرفع CircuitOpenError إذا كان قاطع الدائرة مفتوحاً، و TimeoutError عند انتهاء المهلة.
+    """
+    guard = get_call_guard()
+    if not guard.breaker.allow_request():
+        raise CircuitOpenError("⛔ تم إيقاف الإرسال مؤقتاً: Gemini API لا يستجيب (قاطع الدائرة مفتوح).")
+
+    config = config or genai.types.GenerateContentConfig(temperature=0.0)
+
+    def _call():
+        call_start = time.monotonic()
+        response = client.models.generate_content(model=MODEL_NAME, contents=contents, config=config)
+        return response, time.monotonic() - call_start
+
+    start = time.monotonic()
+    deadline = start + GEMINI_CALL_TIMEOUT_SECONDS
+    hedge_at = start + guard.hedge_delay(call_class)
+    hedged = not HEDGE_ENABLED
+    guard.record_call()
+    pending = {guard.executor.submit(_call)}
+    last_error = None
+
+    while pending:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        wait_until = deadline if hedged else min(deadline, hedge_at)
+        done, pending = concurrent.futures.wait(
+            pending, timeout=max(0, wait_until - now), return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            try:
+                response, latency = future.result()
+            except Exception as e:
+                last_error = e
+                continue
+            guard.record_latency(latency, call_class)
+            guard.breaker.record_success()
+            _call_stats.latency = latency
+            return response
+
+        if not hedged and time.monotonic() >= hedge_at and pending:
+            hedged = True
+            if guard.try_acquire_hedge():
+                pending.add(guard.executor.submit(_call))
+
+    if last_error is not None and not pending:
+        if _is_service_failure(last_error):
+            guard.breaker.record_failure()
+        else:
+            guard.breaker.release_probe()
+        raise last_error
+    guard.breaker.record_failure()
+    raise TimeoutError(f"انتهت المهلة ({GEMINI_CALL_TIMEOUT_SECONDS:.0f} ثانية) دون استجابة من Gemini API.")
+
+# الحد الأقصى لعدد الأحرف المستلمة دون ظهور بداية كائن JSON قبل اعتبار الاستجابة خارج الصيغة
+STREAM_OFF_FORMAT_CHARS = int(os.getenv("STREAM_OFF_FORMAT_CHARS", "600"))
+STREAM_MAX_UNKNOWN_KEYS = int(os.getenv("STREAM_MAX_UNKNOWN_KEYS", "3"))
+
+
+class StreamOffFormatError(ValueError):
+    """يُرفع لإيقاف البث مبكراً عندما تخرج الاستجابة بوضوح عن صيغة JSON المطلوبة."""
+
+
+class IncrementalFieldParser:
+    """تحليل تدريجي لأزواج "الحقل": "القيمة" المكتملة أثناء وصول أجزاء الاستجابة."""
+
+    FIELD_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, expected_fields):
+        self.expected_fields = set(expected_fields)
+        self.buffer = ""
+        self.fields = {}
+        self.unknown_keys = set()
+        self._scan_from = 0
+
+    def feed(self, text):
+        """إضافة جزء جديد وإرجاع قاموس الحقول التي اكتملت بسببه."""
+        self.buffer += text
+        new_fields = {}
+        json_start = self.buffer.find('{')
+        if json_start == -1:
+            if len(self.buffer) > STREAM_OFF_FORMAT_CHARS:
+                raise StreamOffFormatError(f"لم يبدأ كائن JSON بعد {len(self.buffer)} حرف: {self.buffer[:200]}")
+            return new_fields
+
+        for match in self.FIELD_PATTERN.finditer(self.buffer, max(self._scan_from, json_start)):
+            try:
+                key, value = json.loads(f'"{match.group(1)}"'), json.loads(f'"{match.group(2)}"')
+            except ValueError:
+                key, value = match.group(1), match.group(2)
+            self._scan_from = match.end()
+            if key in self.expected_fields:
+                self.fields[key] = value
+                new_fields[key] = value
+            else:
+                self.unknown_keys.add(key)
+
+        if len(self.unknown_keys) > STREAM_MAX_UNKNOWN_KEYS:
+            raise StreamOffFormatError(f"مفاتيح غير متوقعة في الاستجابة: {sorted(self.unknown_keys)[:5]}")
+        return new_fields
+
+
+def generate_content_streaming(contents, on_partial=None, config=None, call_class="stream:1"):
+    """
+    استدعاء generate_content_stream مع تحليل الحقول تدريجياً واستدعاء on_partial(الحقول حتى الآن)
+    عند اكتمال حقول جديدة. يوقف البث مبكراً عند الخروج عن الصيغة (StreamOffFormatError)
+    أو تجاوز المهلة، ويُرجع النص الكامل للاستجابة.
+    """
+    guard = get_call_guard()
+    if not guard.breaker.allow_request():
+        raise CircuitOpenError("⛔ تم إيقاف الإرسال مؤقتاً: Gemini API لا يستجيب (قاطع الدائرة مفتوح).")
+
+    config = config or genai.types.GenerateContentConfig(temperature=0.0)
+    parser = IncrementalFieldParser(REPORT_FIELDS_ARABIC)
+    cancelled = threading.Event()
+
+    def _consume():
+        stream = client.models.generate_content_stream(model=MODEL_NAME, contents=contents, config=config)
+        try:
+            for chunk in stream:
+                if cancelled.is_set():
+                    break
+                new_fields = parser.feed(chunk.text or "")
+                if new_fields and on_partial:
+                    on_partial(dict(parser.fields))
+        finally:
+            # إغلاق البث عند الإيقاف المبكر لتحرير الاتصال
+            if hasattr(stream, 'close'):
+                stream.close()
+        return parser.buffer
+
+    # المهلة تُفرض من خارج حلقة الاستهلاك، فلا يعلق الاستدعاء إذا توقف وصول الأجزاء
+    start = time.monotonic()
+    future = guard.executor.submit(_consume)
+    try:
+        response_text = future.result(timeout=GEMINI_CALL_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        # البث المعلق يتوقف عند الجزء التالي أو عند انتهاء مهلة اتصال العميل
+        cancelled.set()
+        guard.breaker.record_failure()
+        raise TimeoutError(f"انتهت المهلة ({GEMINI_CALL_TIMEOUT_SECONDS:.0f} ثانية) أثناء بث الاستجابة.")
+    except StreamOffFormatError:
+        # الخدمة تعمل لكن الاستجابة خارج الصيغة: لا تُحتسب فشلاً في قاطع الدائرة
+        guard.breaker.record_success()
+        raise
+    except Exception as e:
+        if _is_service_failure(e):
+            guard.breaker.record_failure()
+        else:
+            guard.breaker.release_probe()
+        raise
+
+    latency = time.monotonic() - start
+    guard.record_latency(latency, call_class)
+    guard.breaker.record_success()
+    _call_stats.latency = latency
+    return response_text
+
+
+# ===============================
+# 4. دالة الاستخلاص عبر Gemini API
+# ===============================
+def build_file_part(file_bytes, file_type):
+    """إنشاء كائن الجزء (Part) من البايتات مع تحديد نوع MIME الصحيح للملف."""
     mime_type_map = {
         'pdf': "application/pdf",
         'jpg': "image/jpeg",
@@ -193,13 +617,60 @@ def extract_financial_data(file_bytes, file_name, file_type):
         'png': "image/png"
     }
     mime_type = mime_type_map.get(file_type.lower(), "application/octet-stream")
+    return genai.types.Part.from_bytes(
+        data=file_bytes,
+        mime_type=mime_type
+    )
+
+def parse_json_response(json_text_raw):
+    """استخراج كتلة JSON من نص الاستجابة وتحليلها (يرفع ValueError عند الفشل)."""
+    # نبحث عن أي كتلة تبدأ بـ { وتنتهي بـ } داخل أو بدون ```json
+    match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', json_text_raw, re.DOTALL)
+    if match:
+        json_text = match.group(1)
+    else:
+        # إذا لم يتم العثور على كتلة JSON مع ```json، نحاول تحليل النص بالكامل كـ JSON
+        json_text = json_text_raw
+
+    try:
+        return json.loads(json_text)
+    except Exception as e_json:
+        # نرفع استثناءً ليلتقطه ThreadPoolExecutor في دالة main
+        raise ValueError(f"فشل تحليل JSON: {e_json} - النص: {json_text[:200]}")
+
+def finalize_extracted_record(extracted_data, file_name):
+    """التنظيف والإضافات على سجل مستخلص: التواريخ، اسم الملف، وقت الاستخلاص، مؤشر التشتت والحقول الناقصة."""
+    extracted_data = pre_process_data_fix_dates(extracted_data)
+    extracted_data['اسم الملف'] = file_name
+    
+    riyadh_tz = pytz.timezone('Asia/Riyadh')
+    extracted_data['وقت الاستخلاص'] = pd.Timestamp.now(tz=riyadh_tz).strftime("%Y-%m-%d %H:%M:%S")
+    extracted_data['مؤشر التشتت'] = check_for_suspicion(extracted_data)
+
+    # تأكد من وجود كل الحقول الأساسية
+    for fld in REPORT_FIELDS_ARABIC:
+        if fld not in extracted_data:
+            extracted_data[fld] = "غير متوفر"
+            
+    return extracted_data
+
+
+def extract_financial_data(file_bytes, file_name, file_type, stream=False, on_partial=None, page_range=None, pages=1):
+    """
+    يستدعي Gemini API ليُرجع JSON مطابق للمخطط.
+    عند stream=True تُبث الاستجابة ويُستدعى on_partial بالحقول المكتملة أولاً بأول.
+    page_range=(من، إلى) يعني أن الملف جزء من مستند أكبر مقسم إلى نطاقات صفحات.
+    pages: عدد صفحات الملف (لتحديد فئة زمن الاستجابة).
+    """
+    if not client:
+        return None
+
+    MAX_RETRIES = 3
+    INITIAL_WAIT_SECONDS = 5
 
     # إنشاء كائن الجزء (Part) من البايتات ونوع MIME
     try:
-        file_part = genai.types.Part.from_bytes(
-            data=file_bytes,
-            mime_type=mime_type
-        )
+        file_part = build_file_part(file_bytes, file_type)
     except Exception as e:
         return None
 
@@ -208,53 +679,43 @@ def extract_financial_data(file_bytes, file_name, file_type):
         f"{SYSTEM_PROMPT}",
         file_part
     ]
+    if page_range:
+        content_parts.insert(1, (
+            f"**ملاحظة:** هذا الملف يحتوي على الصفحات {page_range[0]}-{page_range[1]} فقط من مستند أكبر. "
+            "استخلص ما يظهر في هذه الصفحات، واستخدم 'غير متوفر' للحقول غير المذكورة فيها."
+        ))
 
     for attempt in range(MAX_RETRIES):
         try:
-            # 2. استدعاء API 
-            response = client.models.generate_content(
-                model=MODEL_NAME,
-                contents=content_parts,
-                # إزالة response_mime_type="application/json" لزيادة المرونة
-                config=genai.types.GenerateContentConfig(
-                   temperature=0.0
-                )
+            # 2. استدعاء API (بمهلة قصوى وطلب احتياطي عند التأخر، أو ببث تدريجي)
+            # إزالة response_mime_type="application/json" لزيادة المرونة
+            config = genai.types.GenerateContentConfig(
+               temperature=0.0
             )
-
-            # 3. استخراج النص (نبحث عن كتلة JSON)
-            json_text_raw = response.text
-            
-            # 4. تنظيف النص واستخراج كتلة JSON باستخدام regex
-            # نبحث عن أي كتلة تبدأ بـ { وتنتهي بـ } داخل أو بدون ```json
-            match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```', json_text_raw, re.DOTALL)
-            if match:
-                json_text = match.group(1)
+            if stream:
+                response_text = generate_content_streaming(
+                    content_parts, on_partial=on_partial, config=config, call_class=latency_class("stream", pages)
+                )
             else:
-                # إذا لم يتم العثور على كتلة JSON مع ```json، نحاول تحليل النص بالكامل كـ JSON
-                json_text = json_text_raw
+                response_text = generate_content_guarded(
+                    content_parts, config=config, call_class=latency_class("file", pages)
+                ).text
 
-            # 5. تحليل JSON
-            try:
-                # محاولة تحميل JSON
-                extracted_data = json.loads(json_text)
-            except Exception as e_json:
-                # نرفع استثناءً ليلتقطه ThreadPoolExecutor في دالة main
-                raise ValueError(f"فشل تحليل JSON: {e_json} - النص: {json_text[:200]}") 
-
-            # 6. التنظيف والإضافات
-            extracted_data = pre_process_data_fix_dates(extracted_data)
-            extracted_data['اسم الملف'] = file_name
-            
-            riyadh_tz = pytz.timezone('Asia/Riyadh')
-            extracted_data['وقت الاستخلاص'] = pd.Timestamp.now(tz=riyadh_tz).strftime("%Y-%m-%d %H:%M:%S")
-            extracted_data['مؤشر التشتت'] = check_for_suspicion(extracted_data)
+            # 3. استخراج النص وتحليل كتلة JSON
+            extracted_data = parse_json_response(response_text)
+
+            # 4. التنظيف والإضافات
+            return finalize_extracted_record(extracted_data, file_name)
 
-            # 7. تأكد من وجود كل الحقول الأساسية
-            for fld in REPORT_FIELDS_ARABIC:
-                if fld not in extracted_data:
-                    extracted_data[fld] = "غير متوفر"
-                    
-            return extracted_data 
+        except CircuitOpenError:
+            # لا فائدة من إعادة المحاولة والخدمة متوقفة
+            raise
+
+        except StreamOffFormatError as e:
+            # الاستجابة خرجت عن الصيغة أثناء البث: إعادة المحاولة فوراً دون انتظار
+            if attempt < MAX_RETRIES - 1:
+                continue
+            raise ValueError(f"الاستجابة خارج الصيغة المطلوبة: {e}")
 
         except GeminiAPIError as e:
             error_message = str(e)
@@ -262,7 +723,7 @@ def extract_financial_data(file_bytes, file_name, file_type):
             
             if is_overloaded_error and attempt < MAX_RETRIES - 1:
                 wait_time = INITIAL_WAIT_SECONDS * (2 ** attempt) 
-                time.sleep(wait_time)
+                backoff_sleep(wait_time)
                 continue 
             else:
                 # نرفع استثناءً ليتم الإبلاغ عنه في دالة main
@@ -272,7 +733,7 @@ def extract_financial_data(file_bytes, file_name, file_type):
             is_last = (attempt == MAX_RETRIES - 1)
             wait_time = INITIAL_WAIT_SECONDS * (2 ** attempt)
             if not is_last:
-                time.sleep(wait_time)
+                backoff_sleep(wait_time)
                 continue
             else:
                 # نرفع استثناءً ليتم الإبلاغ عنه في دالة main
@@ -280,6 +741,594 @@ def extract_financial_data(file_bytes, file_name, file_type):
                 
     return None
 
+# ===============================
+# 5. إعادة الاستخلاص الموجّهة للحقول الناقصة
+# ===============================
+# الحد الأقصى لطلبات الاستكمال في الدفعة الواحدة، والحد الأدنى لعدد الحقول الناقصة لتفعيل الطلب
+FOLLOWUP_MAX_PER_BATCH = int(os.getenv("FOLLOWUP_MAX_PER_BATCH", "10"))
+FOLLOWUP_MIN_GAPS = int(os.getenv("FOLLOWUP_MIN_GAPS", "3"))
+
+def needs_followup(gap_fields):
+    """طلب الاستكمال يستحق تكلفته عند وجود رقم دلالة ناقص/غير صالح أو عدد كافٍ من الحقول الناقصة."""
+    return "رقم الدلالة" in gap_fields or len(gap_fields) >= FOLLOWUP_MIN_GAPS
+
+def build_followup_prompt(gap_fields, data):
+    """بناء تعليمات قصيرة تطلب الحقول الناقصة أو غير الصالحة فقط."""
+    fields_json = ", ".join(f'"{fld}": "القيمة"' for fld in gap_fields)
+    prompt = (
+        "أنت نظام استخلاص بيانات آلي فائق الدقة. سبق استخلاص بيانات هذه الوثيقة، "
+        "لكن الحقول التالية لم تُستخلص أو جاءت غير صالحة. اقرأ **الوثيقة بالكامل (في جميع صفحاتها)** واستخلص هذه الحقول فقط. "
+        "حوّل التواريخ إلى صيغة 'YYYY/MM/DD' والأرقام العربية إلى إنجليزية، "
+        "ولا تستخدم 'غير متوفر' إلا إذا كنت متأكداً أن الحقل غير مذكور في الوثيقة. "
+    )
+    if "رقم الدلالة" in gap_fields:
+        reason = data.get("سبب الاشتباه", "غير متوفر")
+        prompt += f"\n'سبب الاشتباه' المستخلص سابقاً: {reason}\n" + DELALAT_RULES_PROMPT + DELALAT_PROMPT_LIST
+    prompt += (
+        "**المخرج المطلوب:** كائن JSON فقط محاط بـ ```json و ``` ويحتوي على المفاتيح التالية فقط:"
+        f"\n\n```json\n{{{fields_json}}}\n```"
+    )
+    return prompt
+
+def refill_missing_fields(file_bytes, file_type, data, gap_fields=None):
+    """
+    يرسل طلباً قصيراً يطلب الحقول الناقصة أو غير الصالحة فقط، ويدمج الإجابات في السجل نفسه.
+    إذا كان الحقل الوحيد المطلوب هو 'رقم الدلالة' (أو لم تُمرر بايتات الملف) يُرسل الطلب نصياً
+    اعتماداً على 'سبب الاشتباه' المستخلص دون إرفاق الوثيقة.
+    يُرجع السجل بعد الدمج (أو السجل كما هو عند الفشل).
+    """
+    if not client:
+        return data
+    gap_fields = gap_fields if gap_fields is not None else detect_extraction_gaps(data)
+    if not gap_fields:
+        return data
+
+    text_only = file_bytes is None or gap_fields == ["رقم الدلالة"]
+    if text_only:
+        gap_fields = [fld for fld in gap_fields if fld == "رقم الدلالة"]
+        reason = str(data.get("سبب الاشتباه", "") or "").strip()
+        if not gap_fields or reason in ['', 'غير متوفر']:
+            return data
+
+    try:
+        content_parts = [build_followup_prompt(gap_fields, data)]
+        if not text_only:
+            content_parts.append(build_file_part(file_bytes, file_type))
+        response = generate_content_guarded(
+            content_parts, call_class=latency_class("followup-text" if text_only else "followup")
+        )
+        followup_data = parse_json_response(response.text)
+    except Exception:
+        # طلب الاستكمال اختياري: نحتفظ بالنتيجة الأصلية عند أي خطأ
+        return data
+
+    merged = dict(data)
+    for fld in gap_fields:
+        value = followup_data.get(fld)
+        if value is None or str(value).strip() in ['', 'غير متوفر']:
+            continue
+        if fld == "رقم الدلالة" and not is_valid_delala(value, merged.get("سبب الاشتباه", "")):
+            continue
+        merged[fld] = str(value).strip()
+
+    merged = pre_process_data_fix_dates(merged)
+    merged['مؤشر التشتت'] = check_for_suspicion(merged)
+    return merged
+
+# ===============================
+# 6. كشف المستندات المكررة أو شبه المكررة قبل الاستخلاص
+# ===============================
+# أقصى مسافة هامينغ بين بصمتي صورة، وأدنى تشابه نصي (Jaccard تقديري) لاعتبار المستند مكرراً
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "3"))
+TEXT_MIN_SIMILARITY = float(os.getenv("TEXT_MIN_SIMILARITY", "0.85"))
+# تطابق الصورة وحدها (بدون نص أو تجزئة مطابقة) يُعرض كتنبيه فقط ولا يؤدي إلى تخطي الملف
+SKIPPABLE_MATCH_KINDS = {'مطابق حرفياً', 'نص متشابه'}
+
+# إعدادات الفهرسة: 4 شرائح × 16 بت لبصمة الصورة (أي مسافة ≤ 3 تشترك في شريحة واحدة على الأقل)،
+# و 32 دالة MinHash مقسمة إلى 8 شرائح × 4 صفوف للتوقيع النصي
+PHASH_BANDS = 4
+PHASH_BAND_BITS = 16
+PHASH_SIZE = 32
+MINHASH_PERMUTATIONS = 32
+MINHASH_ROWS_PER_BAND = 4
+SHINGLE_SIZE = 5
+MIN_TEXT_LAYER_CHARS = 200
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(2209832)
+MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MERSENNE_PRIME), _minhash_rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+def _to_signed_64(value):
+    """تحويل عدد صحيح غير سالب (64 بت) إلى قيمة موقعة مناسبة لعمود BIGINT."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _stable_hash_64(text):
+    """تجزئة ثابتة (لا تتغير بين العمليات) بطول 64 بت."""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+# مصفوفة تحويل جيب التمام المتقطع (DCT-II) لحساب البصمة الإدراكية
+_DCT_MATRIX = np.cos(
+    np.pi * (2 * np.arange(PHASH_SIZE)[None, :] + 1) * np.arange(PHASH_SIZE)[:, None] / (2 * PHASH_SIZE)
+)
+
+def image_phash(image):
+    """
+    بصمة إدراكية (pHash) بطول 64 بت: معاملات DCT منخفضة التردد (8×8) لصورة رمادية 32×32،
+    كل بت يمثل كون المعامل أعلى من الوسيط (بدون المعامل الثابت).
+    """
+    small = image.convert('L').resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.float64)
+    low_freq = (_DCT_MATRIX @ pixels @ _DCT_MATRIX.T)[:8, :8].flatten()
+    median = np.median(low_freq[1:])
+    bits = 0
+    for coefficient in low_freq:
+        bits = (bits << 1) | (1 if coefficient > median else 0)
+    return bits
+
+def text_minhash(text):
+    """توقيع MinHash لمقاطع الكلمات المتتالية (shingles) في النص، أو None إذا كان النص قصيراً."""
+    words = re.findall(r'\w+', arabic_to_english_numbers(text).lower())
+    if len(words) < SHINGLE_SIZE:
+        return None
+    shingle_hashes = {
+        _stable_hash_64(" ".join(words[i:i + SHINGLE_SIZE]))
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+    return [
+        min((a * h + b) % _MERSENNE_PRIME for h in shingle_hashes)
+        for a, b in MINHASH_PARAMS
+    ]
+
+def compute_document_fingerprint(file_bytes, file_name, file_type):
+    """
+    حساب بصمة المستند: تجزئة المحتوى الحرفي، بصمة إدراكية للصفحة الأولى، وتوقيع MinHash لطبقة النص (إن وجدت).
+    يُرجع قاموساً يتضمن مفاتيح الفهرسة المستخدمة للبحث السريع في قاعدة البيانات.
+    """
+    fingerprint = {
+        'اسم الملف': file_name,
+        'بصمة المحتوى': hashlib.sha256(file_bytes).hexdigest(),
+        'بصمة الصورة': None,
+        'توقيع النص': None,
+    }
+
+    try:
+        if file_type == 'pdf':
+            if fitz:
+                with fitz.open(stream=file_bytes, filetype='pdf') as doc:
+                    if doc.page_count:
+                        pix = doc[0].get_pixmap(dpi=50)
+                        page_image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+                        fingerprint['بصمة الصورة'] = image_phash(page_image)
+                    text = "".join(page.get_text() for page in doc)
+                    if len(text.strip()) >= MIN_TEXT_LAYER_CHARS:
+                        fingerprint['توقيع النص'] = text_minhash(text)
+        else:
+            with Image.open(io.BytesIO(file_bytes)) as img:
+                fingerprint['بصمة الصورة'] = image_phash(img)
+    except Exception:
+        # الملفات التالفة أو غير المدعومة تُقارن بتجزئة المحتوى فقط
+        pass
+
+    index_keys = []
+    if fingerprint['بصمة الصورة'] is not None:
+        phash = fingerprint['بصمة الصورة']
+        fingerprint['بصمة الصورة'] = _to_signed_64(phash)
+        band_mask = (1 << PHASH_BAND_BITS) - 1
+        for band in range(PHASH_BANDS):
+            band_value = (phash >> (band * PHASH_BAND_BITS)) & band_mask
+            index_keys.append(('صورة', (band << PHASH_BAND_BITS) + band_value))
+    if fingerprint['توقيع النص']:
+        signature = fingerprint['توقيع النص']
+        for band in range(MINHASH_PERMUTATIONS // MINHASH_ROWS_PER_BAND):
+            rows = signature[band * MINHASH_ROWS_PER_BAND:(band + 1) * MINHASH_ROWS_PER_BAND]
+            band_key = _stable_hash_64(f"{band}:" + ",".join(map(str, rows)))
+            index_keys.append(('نص', _to_signed_64(band_key)))
+    fingerprint['مفاتيح الفهرسة'] = index_keys
+    return fingerprint
+
+def compare_fingerprints(fp_a, fp_b):
+    """
+    مقارنة بصمتين: يُرجع وصفاً لنوع التطابق ('مطابق حرفياً' أو 'صورة متشابهة' أو 'نص متشابه')
+    مع درجة التشابه، أو None إذا لم يكونا متشابهين.
+    """
+    if fp_a['بصمة المحتوى'] == fp_b['بصمة المحتوى']:
+        return 'مطابق حرفياً', 1.0
+
+    sig_a, sig_b = fp_a.get('توقيع النص'), fp_b.get('توقيع النص')
+    if sig_a and sig_b and len(sig_a) == len(sig_b):
+        similarity = sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+        if similarity >= TEXT_MIN_SIMILARITY:
+            return 'نص متشابه', similarity
+        # النصان مختلفان: تشابه الصفحة الأولى (نفس القالب أو الترويسة) لا يكفي
+        return None
+
+    hash_a, hash_b = fp_a.get('بصمة الصورة'), fp_b.get('بصمة الصورة')
+    if hash_a is not None and hash_b is not None:
+        distance = bin((hash_a ^ hash_b) & ((1 << 64) - 1)).count('1')
+        if distance <= PHASH_MAX_DISTANCE:
+            return 'صورة متشابهة', 1 - distance / 64
+
+    return None
+
+def find_near_duplicates(fingerprints, known_fingerprints=()):
+    """
+    البحث عن نسخة سابقة لكل بصمة: في المستندات المحفوظة (عبر فهرس قاعدة البيانات)،
+    وفي البصمات المعروفة في الجلسة، وفي الملفات السابقة من الدفعة نفسها.
+    يُرجع قاموساً {رقم الملف في الدفعة: (اسم الملف الأصلي، نوع التطابق، الدرجة)} بأقوى تطابق لكل ملف
+    (التطابق الحرفي أو النصي مقدم على تطابق الصورة وحدها).
+    """
+    duplicates = {}
+    db_candidates = fetch_fingerprint_candidates(fingerprints) or {}
+    seen = list(known_fingerprints)
+
+    for i, fp in enumerate(fingerprints):
+        best = None
+        for candidate in list(db_candidates.get(i, [])) + seen:
+            match = compare_fingerprints(fp, candidate)
+            if match and (best is None or (match[0] in SKIPPABLE_MATCH_KINDS, match[1]) >
+                          (best[1] in SKIPPABLE_MATCH_KINDS, best[2])):
+                best = (candidate['اسم الملف'], *match)
+        if best:
+            duplicates[i] = best
+        if best is None or best[1] not in SKIPPABLE_MATCH_KINDS:
+            seen.append(fp)
+    return duplicates
+
+# ===============================
+# 7. جدولة مهام الاستخلاص حسب الحجم وتقسيم ملفات PDF الكبيرة
+# ===============================
+# PDF_SPLIT_MIN_PAGES: الملفات التي تتجاوز هذا العدد من الصفحات تُقسم إلى أجزاء بطول PDF_SPLIT_PAGES
+PDF_SPLIT_MIN_PAGES = int(os.getenv("PDF_SPLIT_MIN_PAGES", "20"))
+PDF_SPLIT_PAGES = int(os.getenv("PDF_SPLIT_PAGES", "10"))
+# تقدير أولي لزمن معالجة الصفحة الواحدة (يُحدّث من الأزمنة المرصودة) وزمن إضافي لكل ميغابايت
+DEFAULT_SECONDS_PER_PAGE = float(os.getenv("DEFAULT_SECONDS_PER_PAGE", "6"))
+SECONDS_PER_MB = float(os.getenv("SECONDS_PER_MB", "2"))
+# توزيع عادل لسعة الاستدعاء بين المستخدمين (الجلسات) المتزامنين
+FAIR_SCHEDULING = os.getenv("FAIR_SCHEDULING", "1") == "1"
+MAX_GLOBAL_CONCURRENT_CALLS = int(os.getenv("MAX_GLOBAL_CONCURRENT_CALLS", "20"))
+
+
+class PageCostModel:
+    """متوسط متحرك أُسّي لزمن معالجة الصفحة الواحدة، يُستخدم لتقدير تكلفة كل ملف."""
+
+    def __init__(self, seconds_per_page, alpha=0.2):
+        self.seconds_per_page = seconds_per_page
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def record(self, seconds, pages):
+        with self._lock:
+            observed = seconds / max(pages, 1)
+            self.seconds_per_page = (1 - self.alpha) * self.seconds_per_page + self.alpha * observed
+
+    def estimate(self, pages, size_bytes):
+        with self._lock:
+            return pages * self.seconds_per_page + size_bytes / (1024 * 1024) * SECONDS_PER_MB
+
+
+class FairSlotLimiter:
+    """
+    حد أقصى مشترك لعدد الاستدعاءات المتزامنة، يُمنح فيه كل مقعد يتحرر للمستخدم
+    الأقل استخداماً حالياً بين المنتظرين، فلا تحتكر دفعة كبيرة لمستخدم واحد السعة.
+    """
+
+    def __init__(self, max_slots):
+        self.max_slots = max_slots
+        self._active = {}
+        self._waiting = {}
+        self._condition = threading.Condition()
+
+    def _next_owner(self):
+        waiting_owners = [owner for owner, count in self._waiting.items() if count > 0]
+        return min(waiting_owners, key=lambda owner: self._active.get(owner, 0), default=None)
+
+    def acquire(self, owner):
+        with self._condition:
+            self._waiting[owner] = self._waiting.get(owner, 0) + 1
+            while sum(self._active.values()) >= self.max_slots or self._next_owner() != owner:
+                self._condition.wait()
+            self._waiting[owner] -= 1
+            self._active[owner] = self._active.get(owner, 0) + 1
+            # قد يبقى مقعد متاح لمنتظر آخر أصبح الآن صاحب الأولوية
+            self._condition.notify_all()
+
+    def release(self, owner):
+        with self._condition:
+            self._active[owner] -= 1
+            self._condition.notify_all()
+
+
+@st.cache_resource
+def get_scheduler_state():
+    """نموذج التكلفة ومحدد السعة المشتركان بين الجلسات."""
+    return PageCostModel(DEFAULT_SECONDS_PER_PAGE), FairSlotLimiter(MAX_GLOBAL_CONCURRENT_CALLS)
+
+
+# مالك المقعد الذي يحجزه الخيط الحالي (يضبطه run_extraction_unit)
+_held_slot = threading.local()
+
+
+def backoff_sleep(seconds):
+    """
+    الانتظار بين محاولات الاستدعاء مع تحرير مقعد السعة المشتركة أثناءه (إن كان الخيط يحجز مقعداً)،
+    حتى لا يحجز مستخدم ينتظر إعادة المحاولة مقاعد المستخدمين الآخرين دون عمل.
+    """
+    owner = getattr(_held_slot, 'owner', None)
+    if owner is None:
+        time.sleep(seconds)
+        return
+    _, limiter = get_scheduler_state()
+    limiter.release(owner)
+    try:
+        time.sleep(seconds)
+    finally:
+        limiter.acquire(owner)
+
+
+def count_pdf_pages(file_bytes):
+    """عدد صفحات ملف PDF (عبر PyMuPDF إن وجدت، وإلا بعدّ كائنات الصفحات في الملف)."""
+    if fitz:
+        try:
+            with fitz.open(stream=file_bytes, filetype='pdf') as doc:
+                return doc.page_count
+        except Exception:
+            pass
+    return max(1, len(re.findall(rb'/Type\s*/Page(?!s)', file_bytes)))
+
+
+def split_pdf_pages(file_bytes, pages_per_part):
+    """
+    تقسيم ملف PDF إلى أجزاء كل منها pages_per_part صفحة، بترتيب الصفحات.
+    يُرجع قائمة (البايتات، عدد الصفحات، نطاق الصفحات (من، إلى) بترقيم يبدأ من 1).
+    """
+    parts = []
+    with fitz.open(stream=file_bytes, filetype='pdf') as doc:
+        for start in range(0, doc.page_count, pages_per_part):
+            end = min(start + pages_per_part, doc.page_count) - 1
+            with fitz.open() as part_doc:
+                part_doc.insert_pdf(doc, from_page=start, to_page=end)
+                parts.append((part_doc.tobytes(), end - start + 1, (start + 1, end + 1)))
+    return parts
+
+
+def plan_extraction_units(tasks, owner="default", pack=False):
+    """
+    تحويل الملفات إلى وحدات عمل مرتبة حسب التكلفة التقديرية (الأطول أولاً لتقليل زمن الدفعة الكلي).
+    ملفات PDF الكبيرة تُقسم إلى نطاقات صفحات تُستخلص بالتوازي ثم تُدمج في سجل واحد.
+    عند pack=True تُجمع الصور الصغيرة في وحدات تحتوي عدة مستندات ('members').
+    """
+    cost_model, _ = get_scheduler_state()
+    units = []
+    packable = []
+    for file_index, (file_bytes, file_name, file_type) in enumerate(tasks):
+        if pack and file_type in PACKABLE_TYPES and len(file_bytes) <= PACK_MAX_BYTES:
+            packable.append({'file': file_index, 'bytes': file_bytes, 'name': file_name, 'type': file_type})
+            continue
+
+        pages = count_pdf_pages(file_bytes) if file_type == 'pdf' else 1
+        parts = [(file_bytes, pages, None)]
+        if file_type == 'pdf' and fitz and pages > PDF_SPLIT_MIN_PAGES:
+            try:
+                parts = split_pdf_pages(file_bytes, PDF_SPLIT_PAGES)
+            except Exception:
+                parts = [(file_bytes, pages, None)]
+
+        for part_index, (part_bytes, part_pages, page_range) in enumerate(parts):
+            units.append({
+                'owner': owner,
+                'file': file_index,
+                'bytes': part_bytes,
+                'name': file_name,
+                'type': file_type,
+                'pages': part_pages,
+                'part': part_index,
+                'parts': len(parts),
+                'page_range': page_range,
+                'cost': cost_model.estimate(part_pages, len(part_bytes)),
+            })
+
+    for start in range(0, len(packable), PACK_SIZE):
+        members = packable[start:start + PACK_SIZE]
+        if len(members) == 1:
+            units.append(single_member_unit(members[0], owner))
+            continue
+        units.append({
+            'owner': owner,
+            'members': members,
+            'name': "، ".join(member['name'] for member in members),
+            'pages': len(members),
+            'cost': cost_model.estimate(len(members), sum(len(member['bytes']) for member in members)),
+        })
+
+    units.sort(key=lambda unit: unit['cost'], reverse=True)
+    return units
+
+
+def single_member_unit(member, owner="default"):
+    """وحدة عمل منفردة لمستند من حزمة (عند عدم اكتمال الحزمة أو فشل استخلاصه فيها)."""
+    cost_model, _ = get_scheduler_state()
+    return {
+        'owner': owner, **member, 'pages': 1, 'part': 0, 'parts': 1,
+        'cost': cost_model.estimate(1, len(member['bytes'])),
+    }
+
+
+def run_extraction_unit(unit, stream=False, on_partial=None):
+    """
+    تنفيذ وحدة عمل واحدة ضمن السعة المشتركة وتحديث نموذج التكلفة بالزمن المرصود.
+    on_partial(unit, الحقول) يُستدعى أثناء البث عند stream=True (الحزم لا تُبث).
+    وحدات الحزم تُرجع قائمة بنتيجة كل مستند: السجل، أو None للمستندات التي لم تُستخلص في الحزمة
+    (تُعاد جدولتها كوحدات منفردة في main بدلاً من استخلاصها هنا مع حجز مقعد الحزمة).
+    """
+    cost_model, limiter = get_scheduler_state()
+    if FAIR_SCHEDULING:
+        limiter.acquire(unit['owner'])
+        _held_slot.owner = unit['owner']
+    try:
+        # نموذج التكلفة يتعلم من زمن الاستدعاء الناجح فقط، دون فترات الانتظار بين المحاولات
+        _call_stats.latency = None
+        if unit.get('members'):
+            try:
+                results = extract_packed_financial_data(
+                    [(member['bytes'], member['name'], member['type']) for member in unit['members']]
+                )
+            except CircuitOpenError:
+                raise
+            except Exception:
+                results = [None] * len(unit['members'])
+            if any(results) and _call_stats.latency is not None:
+                cost_model.record(_call_stats.latency, unit['pages'])
+            return results
+
+        data = extract_financial_data(
+            unit['bytes'], unit['name'], unit['type'],
+            stream=stream,
+            on_partial=(lambda fields: on_partial(unit, fields)) if on_partial else None,
+            page_range=unit.get('page_range'),
+            pages=unit['pages']
+        )
+        if data and _call_stats.latency is not None:
+            cost_model.record(_call_stats.latency, unit['pages'])
+        return data
+    finally:
+        if FAIR_SCHEDULING:
+            _held_slot.owner = None
+            limiter.release(unit['owner'])
+
+
+def merge_partial_records(part_records):
+    """
+    دمج نتائج أجزاء ملف واحد (بترتيب الصفحات) في سجل واحد: أول قيمة متوفرة لكل حقل،
+    مع ضم نصوص 'سبب الاشتباه' المختلفة وتوحيد أرقام الدلالة من جميع الأجزاء
+    (إذا خالف الاتحاد قواعد نوع المشتبه به تُستخدم القيمة الأكثر تكراراً بين الأجزاء
+    ويُشار إلى الاختلاف في 'مؤشر التشتت'؛ لا يُفرغ الحقل إذا كانت له قيمة في أي جزء).
+    """
+    part_records = [record for record in part_records if record]
+    if not part_records:
+        return None
+    merged = dict(part_records[0])
+
+    def _available(value):
+        return str(value or "").strip() not in ['', 'غير متوفر', 'nan']
+
+    for fld in REPORT_FIELDS_ARABIC:
+        values = [record.get(fld) for record in part_records if _available(record.get(fld))]
+        if not values:
+            merged[fld] = "غير متوفر"
+        elif fld == "سبب الاشتباه":
+            merged[fld] = "\n".join(dict.fromkeys(str(value).strip() for value in values))
+        elif fld == "رقم الدلالة":
+            continue
+        else:
+            merged[fld] = values[0]
+
+    # رقم الدلالة بعد دمج 'سبب الاشتباه' للتحقق منه مقابل نوع المشتبه به في السجل المدمج
+    reason = merged.get("سبب الاشتباه", "")
+    delala_values = [record.get("رقم الدلالة") for record in part_records if _available(record.get("رقم الدلالة"))]
+    numbers = set()
+    for value in delala_values:
+        numbers.update(
+            int(item) for item in re.findall(r'\d+', arabic_to_english_numbers(str(value)))
+            if int(item) in DELALAT_MAPPING
+        )
+    union = ",".join(str(num) for num in sorted(numbers))
+    delala_warning = ""
+    if numbers and is_valid_delala(union, reason):
+        merged["رقم الدلالة"] = union
+    elif delala_values:
+        valid_values = [value for value in delala_values if is_valid_delala(value, reason)]
+        merged["رقم الدلالة"] = Counter(valid_values or delala_values).most_common(1)[0][0]
+        if len(set(delala_values)) > 1:
+            delala_warning = "⚠️ (رقم الدلالة مختلف بين أجزاء الملف)"
+        else:
+            delala_warning = "⚠️ (رقم الدلالة لا يطابق نوع المشتبه به)"
+    else:
+        merged["رقم الدلالة"] = "غير متوفر"
+
+    merged = pre_process_data_fix_dates(merged)
+    merged['مؤشر التشتت'] = check_for_suspicion(merged)
+    if delala_warning:
+        indicator = merged['مؤشر التشتت'] if merged['مؤشر التشتت'] != "✅ سليم" else ""
+        merged['مؤشر التشتت'] = f"{indicator} {delala_warning}".strip()
+    return merged
+
+
+# ===============================
+# 8. تجميع الصور الصغيرة في طلب واحد (Request Packing)
+# ===============================
+# الصور الأصغر من PACK_MAX_BYTES تُجمع حتى PACK_SIZE مستندات في الطلب الواحد
+PACK_MAX_BYTES = int(os.getenv("PACK_MAX_BYTES", str(1536 * 1024)))
+PACK_SIZE = int(os.getenv("PACK_SIZE", "4"))
+PACKABLE_TYPES = {'jpg', 'jpeg', 'png'}
+PACK_INDEX_KEY = "رقم المستند"
+
+
+def build_packed_prompt(document_count):
+    """
+    تعليمات استخلاص عدة وثائق مرقمة في طلب واحد: نفس قواعد الاستخلاص والدلالات المستخدمة
+    في SYSTEM_PROMPT، مع مقدمة وصيغة مخرج خاصة (مصفوفة JSON بدلاً من كائن واحد).
+    """
+    packed_template = FIELDS_JSON_TEMPLATE.replace("{\n", f'{{\n"{PACK_INDEX_KEY}": "رقم الوثيقة",\n', 1)
+    return (
+        f"أنت نظام استخلاص بيانات آلي (Gemini API) فائق الدقة. أُرفقت {document_count} وثائق منفصلة (صور)، "
+        "تسبق كل وثيقة علامة 'المستند رقم N'. مهمتك هي قراءة كل وثيقة واستخلاص جميع بياناتها وفقاً للحقول المطلوبة أدناه، "
+        "**ويجب إخراج قيمة لكل حقل لكل وثيقة.** طبّق التعليمات التالية على كل وثيقة **بشكل مستقل تماماً** "
+        "ولا تنقل أي قيمة من وثيقة إلى أخرى. "
+    ) + EXTRACTION_RULES_PROMPT + DELALAT_RULES_PROMPT + DELALAT_PROMPT_LIST + (
+        "**المخرج المطلوب (Output Format):** "
+        f"يجب أن تكون الإجابة الوحيدة هي **مصفوفة JSON** محاطة بـ ```json و ``` تحتوي على {document_count} كائنات، "
+        f"كائن واحد لكل وثيقة، يحتوي على المفتاح \"{PACK_INDEX_KEY}\" (رقم الوثيقة كما في العلامة) وعلى جميع المفاتيح التالية "
+        "(حتى لو كانت القيمة 'غير متوفر'). يجب استبدال 'القيمة' بالقيمة المستخلصة من الوثيقة:"
+        "\n\n```json\n[\n" + packed_template + ",\n...\n]\n```"
+    )
+
+
+def parse_json_array_response(json_text_raw):
+    """استخراج مصفوفة JSON من نص الاستجابة وتحليلها (يرفع ValueError عند الفشل)."""
+    match = re.search(r'```json\s*(\[[\s\S]*\])\s*```', json_text_raw, re.DOTALL)
+    json_text = match.group(1) if match else json_text_raw
+    try:
+        parsed = json.loads(json_text)
+    except Exception as e_json:
+        raise ValueError(f"فشل تحليل مصفوفة JSON: {e_json} - النص: {json_text[:200]}")
+    if not isinstance(parsed, list):
+        raise ValueError("الاستجابة ليست مصفوفة JSON.")
+    return parsed
+
+
+def extract_packed_financial_data(documents):
+    """
+    استخلاص عدة مستندات صغيرة [(البايتات، اسم الملف، النوع)] في طلب واحد.
+    يُرجع قائمة بنفس ترتيب المستندات: السجل المستخلص أو None للمستندات التي لم تُرجع نتيجة صالحة.
+    """
+    if not client:
+        return [None] * len(documents)
+
+    content_parts = [build_packed_prompt(len(documents))]
+    for number, (file_bytes, _, file_type) in enumerate(documents, start=1):
+        content_parts.append(f"المستند رقم {number}:")
+        content_parts.append(build_file_part(file_bytes, file_type))
+
+    response = generate_content_guarded(content_parts, call_class=latency_class("pack", len(documents)))
+    records = parse_json_array_response(response.text)
+
+    results = [None] * len(documents)
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        try:
+            number = int(arabic_to_english_numbers(str(record.pop(PACK_INDEX_KEY, ""))).strip())
+        except ValueError:
+            continue
+        # نتجاهل الأرقام المكررة أو خارج النطاق: تلك المستندات تُعاد منفردة
+        if 1 <= number <= len(documents) and results[number - 1] is None:
+            results[number - 1] = finalize_extracted_record(record, documents[number - 1][1])
+    return results
+
+
 # ===============================
 # وظائف التقرير وواجهة المستخدم (بدون تغيير)
 # ===============================
@@ -314,6 +1363,122 @@ def create_final_report_from_db(records, column_names):
     return output.read()
 
 
+# ===============================
+# جدول الجلسة المضغوط والتعديل على صفحات
+# ===============================
+# أعمدة قليلة القيم المختلفة تُخزن بنوع category لتقليل الذاكرة
+CATEGORICAL_COLUMNS = ["الجنسية", "المدينة", "الحالة الاجتماعية", "رقم الدلالة"]
+DELALA_DESCRIPTION_COLUMN = 'نص الدلالة المطابقة (للمراجعة)'
+# عمود مخفي يربط كل صف ببصمة مستنده في الجلسة (أسماء الملفات قد تتكرر بين الملفات والدفعات)
+FINGERPRINT_KEY_COLUMN = 'بصمة المحتوى'
+EDITOR_PAGE_SIZES = [25, 50, 100, 200]
+
+
+def compact_extracted_df(df):
+    """تحويل الأعمدة قليلة القيم إلى category وإعادة ترقيم الفهرس."""
+    df = df.reset_index(drop=True)
+    for col in CATEGORICAL_COLUMNS + [DELALA_DESCRIPTION_COLUMN]:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def describe_delala(delala_value):
+    """نص الدلالة (أو الدلالات المفصولة بفاصلة) المطابق لرقم الدلالة المستخلص."""
+    delala_num_str = str(delala_value if pd.notna(delala_value) else 'غير متوفر').strip()
+    descriptions = []
+    # معالجة الأرقام المتعددة المفصولة بفاصلة
+    for num_item in delala_num_str.split(','):
+        try:
+            num = int(num_item.strip())
+            descriptions.append(f"({num}) {DELALAT_MAPPING.get(num, 'رقم الدلالة المستخلصة غير صحيح')}")
+        except ValueError:
+            descriptions.append(f"(غير صحيح) {num_item.strip()}")
+    return "\n\n".join(descriptions)
+
+
+def delala_descriptions(delala_series):
+    """
+    حساب نص الدلالة لعمود كامل دفعة واحدة: يُحسب النص مرة واحدة لكل قيمة مختلفة
+    ثم يُوزع على الصفوف عبر رموز الفئات (category codes).
+    """
+    categories = delala_series.astype('category')
+    mapping = {value: describe_delala(value) for value in categories.cat.categories}
+    descriptions = categories.map(mapping)
+    if descriptions.isna().any():
+        descriptions = descriptions.astype(object).fillna(describe_delala(None))
+    return descriptions.astype('category')
+
+
+def _set_cell(df, row_pos, col, value):
+    """تعيين قيمة خلية مع إضافة الفئة الجديدة للأعمدة من نوع category عند الحاجة."""
+    if col not in df.columns:
+        df[col] = None
+    if isinstance(df[col].dtype, pd.CategoricalDtype) and pd.notna(value) and value not in df[col].cat.categories:
+        df[col] = df[col].cat.add_categories([value])
+    df.iat[row_pos, df.columns.get_loc(col)] = value
+
+
+def apply_editor_changes(editor_key, page_start):
+    """
+    تطبيق تعديلات صفحة المحرر (الصفوف المعدلة/المضافة/المحذوفة) على جدول الجلسة مباشرة،
+    ثم تغيير مفتاح المحرر حتى لا تُطبق التعديلات نفسها مرة أخرى.
+    """
+    changes = st.session_state.get(editor_key) or {}
+    df = st.session_state['extracted_data_df']
+
+    for row_pos, row_changes in changes.get('edited_rows', {}).items():
+        for col, value in row_changes.items():
+            _set_cell(df, page_start + int(row_pos), col, value)
+
+    deleted_positions = [page_start + int(pos) for pos in changes.get('deleted_rows', [])]
+    if deleted_positions:
+        df = df.drop(index=df.index[deleted_positions])
+
+    added_rows = changes.get('added_rows', [])
+    if added_rows:
+        df = pd.concat([df.astype(object), pd.DataFrame(added_rows)], ignore_index=True)
+
+    st.session_state['extracted_data_df'] = compact_extracted_df(df)
+    st.session_state['editor_version'] = st.session_state.get('editor_version', 0) + 1
+
+
+def display_paginated_editor():
+    """عرض جدول البيانات المستخلصة في صفحات، بحيث لا يُرسل إلى المتصفح إلا الصفحة الحالية."""
+    df = st.session_state['extracted_data_df']
+    col_size, col_page, col_info = st.columns([1, 1, 2])
+    with col_size:
+        page_size = st.selectbox("عدد الصفوف في الصفحة", EDITOR_PAGE_SIZES, index=1)
+    total_pages = max(1, -(-len(df) // page_size))
+    # مفتاح ثابت يحفظ الصفحة الحالية عند تغير عدد الصفوف، مع حصرها ضمن عدد الصفحات الجديد
+    if st.session_state.get('editor_page', 1) > total_pages:
+        st.session_state['editor_page'] = total_pages
+    with col_page:
+        page = st.number_input(
+            "الصفحة", min_value=1, max_value=total_pages, step=1, key="editor_page"
+        )
+    with col_info:
+        # دون deep=True: لا نمر على كل النصوص في كل تفاعل (الحجم تقريبي لأعمدة النصوص)
+        memory_kb = df.memory_usage().sum() / 1024
+        st.caption(f"إجمالي الصفوف: {len(df)} | عدد الصفحات: {total_pages} | حجم الجدول في الذاكرة (تقريبي): {memory_kb:,.0f} KB")
+
+    page_start = (page - 1) * page_size
+    # عرض الأعمدة المصنفة كنص عادي داخل المحرر حتى يمكن إدخال قيم جديدة
+    page_df = df.iloc[page_start:page_start + page_size].astype(
+        {col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)}
+    )
+    editor_key = f"extracted_editor_{st.session_state.get('editor_version', 0)}_{page}_{page_size}"
+    st.data_editor(
+        page_df,
+        use_container_width=True,
+        num_rows="dynamic",
+        key=editor_key,
+        on_change=apply_editor_changes,
+        args=(editor_key, page_start),
+        column_config={FINGERPRINT_KEY_COLUMN: None}
+    )
+
+
 def display_basic_stats():
     """عرض الإحصائيات الأساسية للسجلات المحفوظة."""
     st.markdown("---")
@@ -328,6 +1493,46 @@ def display_basic_stats():
     st.markdown("---")
 
 
+def display_related_reports():
+    """البحث عن التقارير المرتبطة برقم هوية/جوال/سجل تجاري وعرض شبكة التقارير المترابطة."""
+    st.subheader("🔗 التقارير المرتبطة")
+    col_search, col_scope = st.columns([3, 2])
+    with col_search:
+        search_value = st.text_input("رقم الهوية أو الجوال أو السجل التجاري")
+    with col_scope:
+        scope = st.radio(
+            "نطاق البحث",
+            ["التقارير المرتبطة مباشرة", "الشبكة المترابطة بالكامل"],
+            horizontal=True
+        )
+
+    if search_value and st.button("🔍 بحث عن التقارير المرتبطة"):
+        max_depth = 1 if scope == "التقارير المرتبطة مباشرة" else None
+        with st.spinner("⏳ جاري البحث في فهرس الكيانات..."):
+            records, column_names, links = fetch_related_reports(search_value, max_depth=max_depth)
+        if records is None:
+            st.error("فشل في البحث عن التقارير المرتبطة.")
+        elif not records:
+            st.info("لا توجد تقارير محفوظة مرتبطة بهذا الرقم.")
+        else:
+            st.success(f"✅ تم العثور على {len(records)} تقرير مرتبط.")
+            st.dataframe(pd.DataFrame(records, columns=column_names), use_container_width=True)
+            if links:
+                st.markdown("**الأرقام المشتركة بين التقارير:**")
+                st.dataframe(
+                    pd.DataFrame(links, columns=["نوع الكيان", "القيمة", "عدد التقارير"]),
+                    use_container_width=True
+                )
+
+    with st.expander("⚙️ صيانة فهرس الكيانات"):
+        st.caption("يتم تحديث الفهرس تلقائياً عند الحفظ. أعد بنائه فقط للسجلات المحفوظة قبل إنشائه.")
+        if st.button("🔄 إعادة بناء فهرس الكيانات"):
+            with st.spinner("⏳ جاري إعادة بناء الفهرس..."):
+                if rebuild_entity_index():
+                    st.success("✅ تمت إعادة بناء فهرس الكيانات.")
+    st.markdown("---")
+
+
 # ===============================
 # CSS وواجهة Streamlit
 # ===============================
@@ -347,6 +1552,17 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+@st.cache_resource
+def initialize_db_once():
+    """
+    تهيئة قاعدة البيانات مرة واحدة لكل عملية خادم بدلاً من كل إعادة تشغيل للسكربت.
+    الفشل يرفع استثناءً فلا يُحفظ في الذاكرة المؤقتة وتُعاد المحاولة في التشغيل التالي.
+    """
+    if initialize_db() is False:
+        raise RuntimeError("تعذر إنشاء الجداول")
+    return True
+
+
 # ===============================
 # نقطة البداية للتطبيق
 # ===============================
@@ -357,12 +1573,17 @@ def main():
 
     # تهيئة قاعدة البيانات
     try:
-        initialize_db()
+        initialize_db_once()
     except Exception as e:
         st.error(f"❌ فشل في تهيئة قاعدة البيانات: {e}")
 
     if 'extracted_data_df' not in st.session_state:
         st.session_state['extracted_data_df'] = pd.DataFrame()
+    if 'document_fingerprints' not in st.session_state:
+        st.session_state['document_fingerprints'] = {}
+    if 'scheduler_owner' not in st.session_state:
+        # اسم المستخدم (عند تفعيل تسجيل الدخول) أو معرف عشوائي للجلسة، لتوزيع السعة بعدالة
+        st.session_state['scheduler_owner'] = st.session_state.get('username') or f"session-{random.getrandbits(32):08x}"
 
     uploaded_files = st.file_uploader(
         "📤 قم بتحميل الملفات (pdf, png, jpg, jpeg) - يمكنك اختيار عدة ملفات",
@@ -371,17 +1592,25 @@ def main():
     )
 
     if uploaded_files:
+
+        auto_refill = st.checkbox(
+            f"🔁 استكمال الحقول الناقصة تلقائياً (طلب قصير للحقول الناقصة فقط، بحد أقصى {FOLLOWUP_MAX_PER_BATCH} ملفات للدفعة)",
+            value=True
+        )
+        skip_duplicates = st.checkbox(
+            "🧬 تخطي المستندات المكررة (تطابق حرفي أو نص متشابه؛ تشابه الصورة وحده يُعرض كتنبيه فقط)",
+            value=True
+        )
+        pack_mode = st.checkbox(
+            f"📦 تجميع الصور الصغيرة (حتى {PACK_SIZE} في الطلب الواحد) لتقليل عدد الطلبات",
+            value=False
+        )
+        stream_mode = st.checkbox(
+            "⚡ بث الاستجابات وعرض الحقول أولاً بأول (مع إيقاف وإعادة الطلبات الخارجة عن الصيغة مبكراً)",
+            value=False
+        )
         
         if st.button("🚀بدء الاستخلاص"):
-            total_files = len(uploaded_files)
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            processed_count = 0
-            all_extracted_data = []
-
-            # رسالة بداية واضحة ومطمئنة للمستخدم
-            status_text.info(f"⏳ بدء معالجة  {total_files} ملفات.")
-            
             # تهيئة المهام للمعالج المتوازي
             tasks = []
             for uploaded_file in uploaded_files:
@@ -389,90 +1618,242 @@ def main():
                 file_type = file_name.split('.')[-1].lower()
                 tasks.append((file_bytes, file_name, file_type))
 
-            # استخدام ThreadPoolExecutor لتنفيذ 10 مهام API بالتوازي
-            MAX_CONCURRENT_WORKERS = 10 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_WORKERS, total_files)) as executor:
-                # إرسال جميع المهام
-                future_to_file = {
-                    executor.submit(extract_financial_data, bytes, name, type_): name
-                    for bytes, name, type_ in tasks
-                }
+            # كشف المستندات المكررة قبل إرسالها إلى API
+            fingerprints = [compute_document_fingerprint(*task) for task in tasks]
+            duplicates = find_near_duplicates(fingerprints, st.session_state['document_fingerprints'].values())
+            for i, (original_name, match_kind, score) in duplicates.items():
+                if match_kind in SKIPPABLE_MATCH_KINDS:
+                    st.warning(
+                        f"🧬 الملف **{tasks[i][1]}** يبدو مكرراً للمستند **{original_name}** "
+                        f"({match_kind}، درجة التشابه {score:.0%})."
+                    )
+                else:
+                    st.info(
+                        f"🧬 صورة الملف **{tasks[i][1]}** تشبه المستند **{original_name}** "
+                        f"(درجة التشابه {score:.0%}). سيتم استخلاصه، يرجى التحقق من عدم تكراره."
+                    )
+            skipped = {i for i, match in duplicates.items() if match[1] in SKIPPABLE_MATCH_KINDS}
+            if skip_duplicates and skipped:
+                tasks = [task for i, task in enumerate(tasks) if i not in skipped]
+                fingerprints = [fp for i, fp in enumerate(fingerprints) if i not in skipped]
+
+            total_files = len(tasks)
+            if total_files == 0:
+                st.info("ℹ️ جميع الملفات المحملة مكررة لمستندات سبق استخلاصها، ولم يتم إرسال أي ملف.")
+            else:
+                progress_bar = st.progress(0)
+                status_text = st.empty()
+                processed_count = 0
+                all_extracted_data = []
+                # رقم الملف في الدفعة لكل سجل (أسماء الملفات قد تتكرر، مثل image.jpg من الجوال)
+                record_file_indices = []
+
+                # رسالة بداية واضحة ومطمئنة للمستخدم
+                status_text.info(f"⏳ بدء معالجة  {total_files} ملفات.")
+
+                # جدولة وحدات العمل: الأطول أولاً، مع تقسيم ملفات PDF الكبيرة إلى نطاقات صفحات
+                units = plan_extraction_units(tasks, owner=st.session_state['scheduler_owner'], pack=pack_mode)
+                total_units = len(units)
+                parts_by_file = {}
+                errors_by_file = {}
+                remaining_by_file = {}
+                for unit in units:
+                    for member in unit.get('members') or [unit]:
+                        remaining_by_file[member['file']] = remaining_by_file.get(member['file'], 0) + 1
+
+                # الصفوف الجزئية أثناء البث: تُحدّث من خيوط المعالجة وتُعرض من الخيط الرئيسي
+                partial_rows = {}
+                partial_placeholder = st.empty()
+
+                def record_partial(unit, fields):
+                    partial_rows[(unit['file'], unit['part'])] = {'اسم الملف': unit['name'], **fields}
+
+                # استخدام ThreadPoolExecutor لتنفيذ 10 مهام API بالتوازي
+                MAX_CONCURRENT_WORKERS = 10 
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_WORKERS, total_units)) as executor:
+                    # إرسال جميع المهام
+                    future_to_unit = {
+                        executor.submit(
+                            run_extraction_unit, unit,
+                            stream=stream_mode, on_partial=record_partial if stream_mode else None
+                        ): unit
+                        for unit in units
+                    }
                 
-                # التكرار على المستقبلات المكتملة وإضافة النتائج
-                for future in concurrent.futures.as_completed(future_to_file):
-                    file_name = future_to_file[future]
-                    try:
-                        data = future.result()
-                        if data:
-                            all_extracted_data.append(data)
-                            st.success(f"✅ تم استخلاص البيانات من **{file_name}** بنجاح.")
-                        else:
-                            st.warning(f"⚠️ فشل استخلاص البيانات من **{file_name}** بشكل كامل.")
-                    except Exception as exc:
-                        # التقاط أي استثناءات مرفوعة داخل extract_financial_data
-                        st.error(f"❌ الملف **{file_name}** أثار استثناء أثناء المعالجة: {exc}")
-                        
-                    processed_count += 1
-                    progress_bar.progress(processed_count / total_files)
+                    # التكرار على المستقبلات المكتملة وإضافة النتائج (مع تحديث الصفوف الجزئية دورياً عند البث)
+                    pending = set(future_to_unit)
+                    while pending:
+                        done, pending = concurrent.futures.wait(
+                            pending,
+                            timeout=0.5 if stream_mode else None,
+                            return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        if stream_mode:
+                            for future in done:
+                                partial_rows.pop((future_to_unit[future].get('file'), future_to_unit[future].get('part')), None)
+                            if partial_rows:
+                                partial_placeholder.dataframe(
+                                    pd.DataFrame(list(partial_rows.values())), use_container_width=True
+                                )
+                            else:
+                                partial_placeholder.empty()
+
+                        for future in done:
+                            unit = future_to_unit[future]
+                            try:
+                                result = future.result()
+                            except Exception as exc:
+                                # التقاط أي استثناءات مرفوعة داخل extract_financial_data
+                                result = exc
+
+                            # نتائج وحدة الحزمة تُوزع على مستنداتها؛ الوحدة العادية تخص جزءاً من ملف واحد
+                            if unit.get('members'):
+                                member_results = result if isinstance(result, list) else [result] * len(unit['members'])
+                                outcomes = []
+                                for member, member_result in zip(unit['members'], member_results):
+                                    if member_result is None:
+                                        # المستندات التي لم تُستخلص في الحزمة تُرسل كوحدات منفردة مستقلة
+                                        retry_unit = single_member_unit(member, unit['owner'])
+                                        retry_future = executor.submit(
+                                            run_extraction_unit, retry_unit,
+                                            stream=stream_mode, on_partial=record_partial if stream_mode else None
+                                        )
+                                        future_to_unit[retry_future] = retry_unit
+                                        pending.add(retry_future)
+                                        total_units += 1
+                                        continue
+                                    outcomes.append((member['file'], member['name'], 0, 1, member_result))
+                            else:
+                                outcomes = [(unit['file'], unit['name'], unit['part'], unit['parts'], result)]
+
+                            processed_count += 1
+                            progress_bar.progress(processed_count / total_units)
+
+                            for file_index, file_name, part, parts, outcome in outcomes:
+                                file_parts = parts_by_file.setdefault(file_index, [None] * parts)
+                                if isinstance(outcome, Exception):
+                                    errors_by_file[file_index] = outcome
+                                else:
+                                    file_parts[part] = outcome
+
+                                # عند اكتمال جميع أجزاء الملف: الدمج في سجل واحد وإبلاغ المستخدم
+                                remaining_by_file[file_index] -= 1
+                                if remaining_by_file[file_index] > 0:
+                                    continue
+                                data = merge_partial_records(file_parts) if parts > 1 else file_parts[0]
+                                if data:
+                                    data['اسم الملف'] = file_name
+                                    all_extracted_data.append(data)
+                                    record_file_indices.append(file_index)
+                                    st.success(f"✅ تم استخلاص البيانات من **{file_name}** بنجاح.")
+                                    if file_index in errors_by_file:
+                                        st.warning(f"⚠️ فشل استخلاص بعض صفحات **{file_name}**: {errors_by_file[file_index]}")
+                                elif file_index in errors_by_file:
+                                    st.error(f"❌ الملف **{file_name}** أثار استثناء أثناء المعالجة: {errors_by_file[file_index]}")
+                                else:
+                                    st.warning(f"⚠️ فشل استخلاص البيانات من **{file_name}** بشكل كامل.")
+
+                    # استكمال الحقول الناقصة أو غير الصالحة بطلبات قصيرة ضمن ميزانية الدفعة
+                    if auto_refill and all_extracted_data:
+                        gaps_by_index = {}
+                        for i, data in enumerate(all_extracted_data):
+                            gaps = detect_extraction_gaps(data)
+                            # الملفات المقسمة لا تُرسل كاملة مرة أخرى: نكتفي باستكمال رقم الدلالة نصياً
+                            if len(parts_by_file[record_file_indices[i]]) > 1:
+                                gaps = [fld for fld in gaps if fld == "رقم الدلالة"]
+                            gaps_by_index[i] = gaps
+                        candidates = sorted(
+                            (i for i, gaps in gaps_by_index.items() if gaps and needs_followup(gaps)),
+                            key=lambda i: len(gaps_by_index[i]),
+                            reverse=True
+                        )[:FOLLOWUP_MAX_PER_BATCH]
+
+                        if candidates:
+                            status_text.info(f"🔁 استكمال الحقول الناقصة في {len(candidates)} ملفات...")
+                            future_to_index = {}
+                            for i in candidates:
+                                file_index = record_file_indices[i]
+                                file_bytes, _, file_type = tasks[file_index]
+                                if len(parts_by_file[file_index]) > 1:
+                                    file_bytes = None
+                                future = executor.submit(
+                                    refill_missing_fields, file_bytes, file_type, all_extracted_data[i], gaps_by_index[i]
+                                )
+                                future_to_index[future] = i
+
+                            for future in concurrent.futures.as_completed(future_to_index):
+                                i = future_to_index[future]
+                                merged = future.result()
+                                remaining_gaps = detect_extraction_gaps(merged)
+                                filled = sum(1 for fld in gaps_by_index[i] if fld not in remaining_gaps)
+                                all_extracted_data[i] = merged
+                                if filled > 0:
+                                    st.info(f"🔁 تم استكمال {filled} حقول في **{merged['اسم الملف']}**.")
             
-            # المعالجة النهائية بعد اكتمال جميع الملفات
-            if all_extracted_data:
-                status_text.success(f"✅ اكتمل استخلاص جميع الملفات ({len(all_extracted_data)} ملفات).")
-                new_df = pd.DataFrame(all_extracted_data)
-                display_cols = ["مؤشر التشتت", "اسم الملف", "وقت الاستخلاص"] + REPORT_FIELDS_ARABIC
-                new_df = new_df.reindex(columns=display_cols, fill_value='غير متوفر')
-                st.session_state['extracted_data_df'] = pd.concat([st.session_state['extracted_data_df'], new_df], ignore_index=True)
-            else:
-                status_text.error("❌ فشل استخلاص أي بيانات.")
-                progress_bar.empty()
+                # عرض أزمنة الاستجابة المرصودة وحالة قاطع الدائرة
+                guard = get_call_guard()
+                if guard.latency.count():
+                    p50, p90, p99 = (guard.latency.percentile(p) for p in (50, 90, 99))
+                    st.caption(
+                        f"⏱️ زمن استجابة Gemini (جميع الطلبات): p50={p50:.1f}ث | p90={p90:.1f}ث | p99={p99:.1f}ث "
+                        f"(مهلة الطلب الاحتياطي لملف من صفحة واحدة {guard.hedge_delay(latency_class('file')):.1f}ث)"
+                    )
+                if guard.breaker.is_open():
+                    st.error("⛔ تم إيقاف الإرسال مؤقتاً لأن Gemini API لا يستجيب. أعد المحاولة بعد قليل.")
+
+                # حفظ بصمات الملفات المستخلصة في الجلسة بمفتاح بصمة المحتوى، وتخزين المفتاح في الصف نفسه
+                # (تُنقل البصمة إلى قاعدة البيانات عند حفظ السجل)
+                for data, file_index in zip(all_extracted_data, record_file_indices):
+                    fingerprint = fingerprints[file_index]
+                    data[FINGERPRINT_KEY_COLUMN] = fingerprint['بصمة المحتوى']
+                    st.session_state['document_fingerprints'][fingerprint['بصمة المحتوى']] = fingerprint
+
+                # المعالجة النهائية بعد اكتمال جميع الملفات
+                if all_extracted_data:
+                    status_text.success(f"✅ اكتمل استخلاص جميع الملفات ({len(all_extracted_data)} ملفات).")
+                    new_df = pd.DataFrame(all_extracted_data)
+                    display_cols = ["مؤشر التشتت", "اسم الملف", "وقت الاستخلاص"] + REPORT_FIELDS_ARABIC + [FINGERPRINT_KEY_COLUMN]
+                    new_df = new_df.reindex(columns=display_cols, fill_value='غير متوفر')
+                    st.session_state['extracted_data_df'] = compact_extracted_df(
+                        pd.concat([st.session_state['extracted_data_df'], new_df], ignore_index=True)
+                    )
+                else:
+                    status_text.error("❌ فشل استخلاص أي بيانات.")
+                    progress_bar.empty()
 
     # جدول قابل للتعديل
     if not st.session_state['extracted_data_df'].empty:
         st.subheader("✏️ جميع البيانات المستخلصة (قابلة للتعديل)")
 
         if st.button("💡 استخرج نص الدلالة المطابقة"):
-            temp_df = st.session_state['extracted_data_df'].copy()
-            if 'نص الدلالة المطابقة (للمراجعة)' in temp_df.columns:
-                temp_df.drop(columns=['نص الدلالة المطابقة (للمراجعة)'], inplace=True, errors='ignore')
-
-            def get_delala_description(row):
-                delala_num_str = str(row.get('رقم الدلالة', 'غير متوفر')).strip()
-                descriptions = []
-                # معالجة الأرقام المتعددة المفصولة بفاصلة
-                for num_item in delala_num_str.split(','):
-                    try:
-                        num = int(num_item.strip())
-                        descriptions.append(f"({num}) {DELALAT_MAPPING.get(num, 'رقم الدلالة المستخلصة غير صحيح')}")
-                    except ValueError:
-                        descriptions.append(f"(غير صحيح) {num_item.strip()}")
-                return "\n\n".join(descriptions)
-
-            if 'رقم الدلالة' in temp_df.columns:
-                temp_df.insert(temp_df.columns.get_loc('رقم الدلالة') + 1,
-                                     'نص الدلالة المطابقة (للمراجعة)',
-                                     temp_df.apply(get_delala_description, axis=1))
-            st.session_state['extracted_data_df'] = temp_df
+            df = st.session_state['extracted_data_df']
+            df.drop(columns=[DELALA_DESCRIPTION_COLUMN], inplace=True, errors='ignore')
+            if 'رقم الدلالة' in df.columns:
+                df.insert(df.columns.get_loc('رقم الدلالة') + 1,
+                          DELALA_DESCRIPTION_COLUMN,
+                          delala_descriptions(df['رقم الدلالة']))
             st.rerun()
 
-        edited_df = st.data_editor(
-            st.session_state['extracted_data_df'],
-            use_container_width=True,
-            num_rows="dynamic"
-        )
+        display_paginated_editor()
         
 
         st.markdown("---")
         if st.button("💾 تأكيد وحفظ التعديلات في قاعدة البيانات"):
             saved_count = 0
+            edited_df = st.session_state['extracted_data_df']
             total_rows = len(edited_df)
             status_placeholder = st.empty()
             for index, row in edited_df.iterrows():
                 row_data = dict(row)
                 # حذف أعمدة مؤقتة قبل الحفظ
                 row_data.pop('مؤشر التشتت', None)
-                row_data.pop('نص الدلالة المطابقة (للمراجعة)', None)
+                row_data.pop(DELALA_DESCRIPTION_COLUMN, None)
+                fingerprint_key = row_data.pop(FINGERPRINT_KEY_COLUMN, None)
                 if save_to_db(row_data):
                     saved_count += 1
+                    fingerprint = st.session_state['document_fingerprints'].pop(fingerprint_key, None)
+                    if fingerprint:
+                        save_document_fingerprint(fingerprint)
                 else:
                     status_placeholder.error(f"❌ فشل حفظ السجل رقم {index + 1}.")
                     break
@@ -488,6 +1869,7 @@ def main():
 
     # إحصائيات وتصدير
     display_basic_stats()
+    display_related_reports()
 
     st.markdown("---")
     st.subheader("📊 تصدير البيانات النهائية")
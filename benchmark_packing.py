@@ -0,0 +1,123 @@
+# benchmark_packing.py
+"""
+مقارنة وضع تجميع الصور الصغيرة (Packing) مع وضع المستند الواحد على مجموعة صور.
+
+الاستخدام:
+    python benchmark_packing.py <مجلد الصور> [--pack-size 4] [--limit 40]
+
+يطبع عدد الطلبات والزمن الكلي وحجم التعليمات المرسلة لكل وضع، ونسبة تطابق كل حقل
+بين الوضعين (نتيجة المستند الواحد هي المرجع).
+"""
+import argparse
+import os
+import time
+
+import app
+
+
+def _normalize(value):
+    """توحيد القيمة للمقارنة: أرقام إنجليزية، بدون مسافات زائدة."""
+    return " ".join(app.arabic_to_english_numbers(str(value or "")).split())
+
+
+def load_documents(folder, limit):
+    """قراءة الصور الصغيرة القابلة للتجميع من المجلد."""
+    documents = []
+    for file_name in sorted(os.listdir(folder)):
+        file_type = file_name.split('.')[-1].lower()
+        path = os.path.join(folder, file_name)
+        if file_type not in app.PACKABLE_TYPES or os.path.getsize(path) > app.PACK_MAX_BYTES:
+            continue
+        with open(path, 'rb') as f:
+            documents.append((f.read(), file_name, file_type))
+        if len(documents) >= limit:
+            break
+    return documents
+
+
+def run_single(documents):
+    """وضع المستند الواحد: طلب لكل مستند."""
+    start = time.monotonic()
+    results = {}
+    for file_bytes, file_name, file_type in documents:
+        try:
+            results[file_name] = app.extract_financial_data(file_bytes, file_name, file_type)
+        except Exception as exc:
+            print(f"  ✗ {file_name}: {exc}")
+            results[file_name] = None
+    return results, len(documents), time.monotonic() - start
+
+
+def run_packed(documents, pack_size):
+    """وضع التجميع: طلب لكل حزمة، ثم طلب منفرد لكل مستند فشل في الحزمة."""
+    start = time.monotonic()
+    results = {}
+    requests = 0
+    fallbacks = 0
+    for i in range(0, len(documents), pack_size):
+        pack = documents[i:i + pack_size]
+        requests += 1
+        try:
+            packed = app.extract_packed_financial_data(pack)
+        except Exception as exc:
+            print(f"  ✗ فشل الحزمة {i // pack_size + 1}: {exc}")
+            packed = [None] * len(pack)
+        for (file_bytes, file_name, file_type), data in zip(pack, packed):
+            if data is None:
+                fallbacks += 1
+                requests += 1
+                try:
+                    data = app.extract_financial_data(file_bytes, file_name, file_type)
+                except Exception as exc:
+                    print(f"  ✗ {file_name}: {exc}")
+            results[file_name] = data
+    return results, requests, fallbacks, time.monotonic() - start
+
+
+def field_agreement(reference, candidate):
+    """نسبة تطابق كل حقل بين نتائج الوضعين للمستندات التي نجحت في كليهما."""
+    names = [name for name in reference if reference[name] and candidate.get(name)]
+    agreement = {}
+    for fld in app.REPORT_FIELDS_ARABIC:
+        matches = sum(
+            1 for name in names
+            if _normalize(reference[name].get(fld)) == _normalize(candidate[name].get(fld))
+        )
+        agreement[fld] = matches / len(names) if names else 0.0
+    return agreement, len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="مقارنة وضع التجميع مع وضع المستند الواحد")
+    parser.add_argument("folder")
+    parser.add_argument("--pack-size", type=int, default=app.PACK_SIZE)
+    parser.add_argument("--limit", type=int, default=40)
+    args = parser.parse_args()
+
+    documents = load_documents(args.folder, args.limit)
+    if not documents:
+        print("لا توجد صور صغيرة في المجلد.")
+        return
+
+    print(f"عدد المستندات: {len(documents)} | حجم الحزمة: {args.pack_size}")
+    single, single_requests, single_time = run_single(documents)
+    packed, packed_requests, fallbacks, packed_time = run_packed(documents, args.pack_size)
+
+    prompt_chars = len(app.SYSTEM_PROMPT)
+    packed_prompt_chars = len(app.build_packed_prompt(args.pack_size))
+    packs = -(-len(documents) // args.pack_size)
+    print(f"\nالمستند الواحد: {single_requests} طلب | {single_time:.1f}ث | "
+          f"أحرف التعليمات {single_requests * prompt_chars:,}")
+    print(f"التجميع:        {packed_requests} طلب ({fallbacks} إعادة منفردة) | {packed_time:.1f}ث | "
+          f"أحرف التعليمات {packs * packed_prompt_chars + fallbacks * prompt_chars:,}")
+
+    agreement, compared = field_agreement(single, packed)
+    print(f"\nتطابق الحقول ({compared} مستند نجح في الوضعين):")
+    for fld, ratio in agreement.items():
+        print(f"  {fld}: {ratio:.0%}")
+    if agreement:
+        print(f"  المتوسط: {sum(agreement.values()) / len(agreement):.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import os
 from dotenv import load_dotenv
 import streamlit as st
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 import pandas as pd
 import re
 from itertools import permutations
@@ -37,6 +38,9 @@ DB_COLUMN_NAMES = [
 
 DATA_KEYS = DB_COLUMN_NAMES
 
+# الأعمدة المستخدمة لربط التقارير ببعضها في فهرس الكيانات
+ENTITY_INDEX_COLUMNS = ["رقم الهوية", "رقم الجوال", "رقم صاحب العمل/ السجل التجاري"]
+
 # ===============================
 # دوال الاتصال والتحويل
 # ===============================
@@ -54,6 +58,32 @@ def arabic_to_english_numbers(text):
     return text.translate(str.maketrans(arabic_map))
 
 
+def normalize_entity_numbers(key, value):
+    """
+    تطبيع قيمة رقم الهوية/الجوال/السجل التجاري إلى قائمة أرقام موحدة للفهرسة:
+    تحويل الأرقام العربية، فصل القيم المتعددة، وحذف المسافات والشرطات وأي رموز أخرى.
+    """
+    if value is None or str(value).strip() in ['غير متوفر', '', 'nan', 'None']:
+        return []
+
+    text = arabic_to_english_numbers(str(value))
+    numbers = []
+    # ملاحظة: الفاصلة العربية '،' تتحول إلى '.' في arabic_to_english_numbers
+    for part in re.split(r'[/,.;|\n]+', text):
+        digits = re.sub(r'[^\d]', '', part)
+        if key == "رقم الجوال":
+            # توحيد صيغ الجوال السعودي: 9665xxxxxxxx و 009665xxxxxxxx و 5xxxxxxxx ← 05xxxxxxxx
+            if digits.startswith('00966'):
+                digits = digits[5:]
+            elif digits.startswith('966') and len(digits) == 12:
+                digits = digits[3:]
+            if len(digits) == 9 and digits.startswith('5'):
+                digits = '0' + digits
+        if len(digits) >= 5 and digits not in numbers:
+            numbers.append(digits)
+    return numbers
+
+
 def connect_db():
     """ينشئ اتصالًا بقاعدة البيانات."""
     try:
@@ -200,12 +230,17 @@ def save_to_db(extracted_data):
         insert_query = sql.SQL("""
             INSERT INTO public.تقارير_الاشتباه ({columns})
             VALUES ({values})
+            RETURNING "معرف التقرير"
         """).format(
             columns=columns_sql,
             values=sql.SQL(', ').join(sql.Placeholder() * len(insert_values)) 
         )
         
         cur.execute(insert_query, insert_values)
+
+        # تحديث فهرس الكيانات في نفس المعاملة
+        report_id = cur.fetchone()[0]
+        _index_report_entities(cur, report_id, extracted_data)
         
         conn.commit()
         cur.close()
@@ -304,13 +339,433 @@ def initialize_db():
                 "وقت الاستخلاص" TIMESTAMP
             )
         """)
+        # معرف فريد لكل تقرير (يُضاف للجداول القديمة دون إعادة كتابتها) وفهرس الكيانات
+        _ensure_report_id_column(cur)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.فهرس_الكيانات (
+                "معرف التقرير" BIGINT,
+                "نوع الكيان" TEXT,
+                "القيمة" TEXT
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_فهرس_الكيانات_القيمة
+            ON public.فهرس_الكيانات ("نوع الكيان", "القيمة")
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_فهرس_الكيانات_التقرير
+            ON public.فهرس_الكيانات ("معرف التقرير")
+        """)
+        # جداول بصمات المستندات المستخدمة لكشف المستندات المكررة أو شبه المكررة
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.بصمات_المستندات (
+                "معرف البصمة" BIGSERIAL PRIMARY KEY,
+                "اسم الملف" TEXT,
+                "بصمة المحتوى" TEXT UNIQUE,
+                "بصمة الصورة" BIGINT,
+                "توقيع النص" BIGINT[],
+                "وقت الإضافة" TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.مفاتيح_البصمات (
+                "معرف البصمة" BIGINT REFERENCES public.بصمات_المستندات ("معرف البصمة") ON DELETE CASCADE,
+                "نوع المفتاح" TEXT,
+                "المفتاح" BIGINT
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_مفاتيح_البصمات
+            ON public.مفاتيح_البصمات ("نوع المفتاح", "المفتاح")
+        """)
+        conn.commit()
+
+        # الفهرس الفريد يُبنى مرة واحدة دون قفل الكتابة على الجدول (CONCURRENTLY لا يعمل داخل معاملة)
+        cur.execute("""
+            SELECT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public' AND c.relname = 'idx_معرف_التقرير'
+        """)
+        index_row = cur.fetchone()
+        # إنهاء معاملة الاستعلام قبل التحويل إلى autocommit (لا يُسمح بتغييره داخل معاملة)
         conn.commit()
+        if not index_row or not index_row[0]:
+            conn.autocommit = True
+            if index_row:
+                # فهرس غير صالح متبقٍ من محاولة CONCURRENTLY سابقة فشلت
+                cur.execute('DROP INDEX CONCURRENTLY IF EXISTS public.idx_معرف_التقرير')
+            cur.execute("""
+                CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_معرف_التقرير
+                ON public.تقارير_الاشتباه ("معرف التقرير")
+            """)
         cur.close()
         conn.close()
         return True
     except Exception as e:
         if conn:
-            conn.rollback()
+            if not conn.autocommit:
+                conn.rollback()
             conn.close()
         st.error(f"❌ خطأ أثناء إنشاء الجدول: {e}")
         return False
+
+
+def _ensure_report_id_column(cur):
+    """
+    يضيف عمود "معرف التقرير" إذا لم يكن موجوداً: عمود BIGINT بقيمة افتراضية من تسلسل،
+    وهي عملية على البيانات الوصفية فقط (لا تعيد كتابة الجدول). السجلات القديمة تبقى بدون معرف
+    حتى تُرقّم على دفعات في rebuild_entity_index.
+    """
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'تقارير_الاشتباه' AND column_name = 'معرف التقرير'
+    """)
+    if cur.fetchone():
+        return
+    cur.execute('CREATE SEQUENCE IF NOT EXISTS public."تقارير_الاشتباه_معرف_التقرير_seq"')
+    cur.execute('ALTER TABLE public.تقارير_الاشتباه ADD COLUMN "معرف التقرير" BIGINT')
+    cur.execute("""
+        ALTER TABLE public.تقارير_الاشتباه
+        ALTER COLUMN "معرف التقرير" SET DEFAULT nextval('public."تقارير_الاشتباه_معرف_التقرير_seq"')
+    """)
+    cur.execute("""
+        ALTER SEQUENCE public."تقارير_الاشتباه_معرف_التقرير_seq"
+        OWNED BY public.تقارير_الاشتباه."معرف التقرير"
+    """)
+
+
+
+# ===============================
+# بصمات المستندات (كشف التكرار)
+# ===============================
+
+FINGERPRINT_COLUMNS = ["اسم الملف", "بصمة المحتوى", "بصمة الصورة", "توقيع النص"]
+FINGERPRINT_CANDIDATE_LIMIT = 200
+
+def save_document_fingerprint(fingerprint):
+    """يحفظ بصمة مستند تم استخلاصه مع مفاتيح الفهرسة الخاصة بها (يتجاهل البصمات المحفوظة مسبقاً)."""
+    conn = connect_db()
+    if not conn:
+        return False
+
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            sql.SQL("""
+                INSERT INTO public.بصمات_المستندات ({columns})
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT ("بصمة المحتوى") DO NOTHING
+                RETURNING "معرف البصمة"
+            """).format(columns=sql.SQL(', ').join(sql.Identifier(col) for col in FINGERPRINT_COLUMNS)),
+            [fingerprint.get(col) for col in FINGERPRINT_COLUMNS]
+        )
+        row = cur.fetchone()
+        if row and fingerprint.get('مفاتيح الفهرسة'):
+            cur.executemany(
+                'INSERT INTO public.مفاتيح_البصمات ("معرف البصمة", "نوع المفتاح", "المفتاح") VALUES (%s, %s, %s)',
+                [(row[0], key_type, key) for key_type, key in fingerprint['مفاتيح الفهرسة']]
+            )
+        conn.commit()
+        cur.close()
+        conn.close()
+        return True
+
+    except Exception as e:
+        st.error(f"❌ فشل حفظ بصمة المستند: {e}")
+        if conn:
+            conn.rollback()
+            conn.close()
+        return False
+
+def fetch_fingerprint_candidates(fingerprints):
+    """
+    يجلب البصمات المحفوظة المرشحة للتطابق مع كل بصمة (نفس تجزئة المحتوى أو مفتاح فهرسة مشترك).
+    يُرجع قاموساً {رقم البصمة في القائمة: [قواميس البصمات المرشحة]}.
+    """
+    if not fingerprints:
+        return {}
+    conn = connect_db()
+    if not conn:
+        return {}
+
+    candidates = {}
+    try:
+        cur = conn.cursor()
+        for i, fingerprint in enumerate(fingerprints):
+            # 1. التطابق الحرفي بتجزئة المحتوى (استعلام مستقل حتى لا يضيع ضمن حد المرشحين)
+            cur.execute(
+                """
+                SELECT "اسم الملف", "بصمة المحتوى", "بصمة الصورة", "توقيع النص"
+                FROM public.بصمات_المستندات
+                WHERE "بصمة المحتوى" = %s
+                """,
+                [fingerprint['بصمة المحتوى']]
+            )
+            exact = cur.fetchall()
+            if exact:
+                candidates[i] = [dict(zip(FINGERPRINT_COLUMNS, row)) for row in exact]
+                continue
+
+            # 2. المرشحون عبر مفاتيح الفهرسة، مرتبين حسب عدد الشرائح المشتركة (الأقرب أولاً)
+            keys = fingerprint.get('مفاتيح الفهرسة') or []
+            if not keys:
+                candidates[i] = []
+                continue
+            cur.execute(
+                """
+                SELECT b."اسم الملف", b."بصمة المحتوى", b."بصمة الصورة", b."توقيع النص"
+                FROM (
+                    SELECT k."معرف البصمة", COUNT(*) AS shared_bands
+                    FROM public.مفاتيح_البصمات k
+                    WHERE (k."نوع المفتاح", k."المفتاح") IN (SELECT * FROM unnest(%s::text[], %s::bigint[]))
+                    GROUP BY k."معرف البصمة"
+                    ORDER BY shared_bands DESC
+                    LIMIT %s
+                ) m
+                JOIN public.بصمات_المستندات b ON b."معرف البصمة" = m."معرف البصمة"
+                ORDER BY m.shared_bands DESC
+                """,
+                [[k[0] for k in keys], [k[1] for k in keys], FINGERPRINT_CANDIDATE_LIMIT]
+            )
+            candidates[i] = [dict(zip(FINGERPRINT_COLUMNS, row)) for row in cur.fetchall()]
+        cur.close()
+        conn.close()
+        return candidates
+
+    except Exception as e:
+        st.error(f"❌ حدث خطأ أثناء البحث عن المستندات المكررة: {e}")
+        if conn:
+            conn.close()
+        return {}
+
+
+
+# ===============================
+# فهرس الكيانات (ربط التقارير المشتركة في الهوية/الجوال/السجل التجاري)
+# ===============================
+
+def _entity_index_rows(report_id, report_data):
+    """صفوف فهرس الكيانات (معرف التقرير، نوع الكيان، القيمة الموحدة) لتقرير واحد."""
+    return [
+        (report_id, key, number)
+        for key in ENTITY_INDEX_COLUMNS
+        for number in normalize_entity_numbers(key, report_data.get(key))
+    ]
+
+
+def _insert_entity_index_rows(cur, rows):
+    """إدراج صفوف فهرس الكيانات دفعة واحدة (ضمن معاملة قائمة)."""
+    if rows:
+        execute_values(
+            cur,
+            'INSERT INTO public.فهرس_الكيانات ("معرف التقرير", "نوع الكيان", "القيمة") VALUES %s',
+            rows
+        )
+
+
+def _index_report_entities(cur, report_id, report_data):
+    """يضيف قيم الكيانات الموحدة لتقرير واحد إلى فهرس الكيانات."""
+    _insert_entity_index_rows(cur, _entity_index_rows(report_id, report_data))
+
+
+def _backfill_report_ids(conn, batch_size):
+    """ترقيم السجلات القديمة التي ليس لها "معرف التقرير" على دفعات، مع تثبيت كل دفعة على حدة."""
+    cur = conn.cursor()
+    while True:
+        cur.execute(
+            """
+            UPDATE public.تقارير_الاشتباه
+            SET "معرف التقرير" = nextval(pg_get_serial_sequence('public.تقارير_الاشتباه', 'معرف التقرير'))
+            WHERE ctid = ANY(ARRAY(
+                SELECT ctid FROM public.تقارير_الاشتباه WHERE "معرف التقرير" IS NULL LIMIT %s
+            ))
+            """,
+            [batch_size]
+        )
+        updated = cur.rowcount
+        conn.commit()
+        if updated == 0:
+            break
+    cur.close()
+
+
+def rebuild_entity_index(batch_size=5000):
+    """
+    يعيد بناء فهرس الكيانات من جدول تقارير_الاشتباه (للسجلات المحفوظة قبل إنشاء الفهرس).
+    يُبنى الفهرس الجديد في جدول مؤقت على دفعات، ثم يُستبدل بالجدول الحالي في معاملة قصيرة،
+    فلا تتوقف عمليات الحفظ أثناء إعادة البناء. التقارير الموجودة في الفهرس الحالي وغير الموجودة
+    في الجديد (المحفوظة أثناء البناء) تُنقل إليه عند الاستبدال.
+    """
+    conn = connect_db()
+    if not conn:
+        return False
+
+    try:
+        _backfill_report_ids(conn, batch_size)
+
+        cur = conn.cursor()
+        cur.execute('SELECT COALESCE(MAX("معرف التقرير"), 0) FROM public.تقارير_الاشتباه')
+        high_water_id = cur.fetchone()[0]
+        cur.execute('DROP TABLE IF EXISTS public.فهرس_الكيانات_جديد')
+        cur.execute('CREATE TABLE public.فهرس_الكيانات_جديد (LIKE public.فهرس_الكيانات)')
+        conn.commit()
+
+        # مؤشر على الخادم (WITH HOLD) لقراءة السجلات على دفعات مع تثبيت كل دفعة
+        read_cur = conn.cursor(name='entity_index_rebuild', withhold=True)
+        read_cur.execute(
+            sql.SQL('SELECT "معرف التقرير", {columns} FROM public.تقارير_الاشتباه WHERE "معرف التقرير" <= %s').format(
+                columns=sql.SQL(', ').join(sql.Identifier(col) for col in ENTITY_INDEX_COLUMNS)
+            ),
+            [high_water_id]
+        )
+        while True:
+            records = read_cur.fetchmany(batch_size)
+            if not records:
+                break
+            rows = [
+                row
+                for record in records
+                for row in _entity_index_rows(record[0], dict(zip(ENTITY_INDEX_COLUMNS, record[1:])))
+            ]
+            if rows:
+                execute_values(
+                    cur,
+                    'INSERT INTO public.فهرس_الكيانات_جديد ("معرف التقرير", "نوع الكيان", "القيمة") VALUES %s',
+                    rows
+                )
+            conn.commit()
+        read_cur.close()
+
+        cur.execute("""
+            CREATE INDEX idx_فهرس_الكيانات_القيمة_جديد
+            ON public.فهرس_الكيانات_جديد ("نوع الكيان", "القيمة")
+        """)
+        cur.execute("""
+            CREATE INDEX idx_فهرس_الكيانات_التقرير_جديد
+            ON public.فهرس_الكيانات_جديد ("معرف التقرير")
+        """)
+        conn.commit()
+
+        # الاستبدال: قفل قصير يمنع الكتابة في الفهرس الحالي أثناء نقل التقارير الأحدث وتبديل الأسماء
+        cur.execute('LOCK TABLE public.فهرس_الكيانات IN EXCLUSIVE MODE')
+        # نقل كل تقرير غير موجود في الفهرس الجديد، لا الأحدث من high_water_id فقط: الحفظ الذي حجز
+        # معرفه قبل قراءة الحد الأعلى واكتمل بعدها يكون معرفه أصغر ولم يُقرأ في الدفعات
+        cur.execute("""
+            INSERT INTO public.فهرس_الكيانات_جديد
+            SELECT old.* FROM public.فهرس_الكيانات old
+            WHERE NOT EXISTS (
+                SELECT 1 FROM public.فهرس_الكيانات_جديد new
+                WHERE new."معرف التقرير" = old."معرف التقرير"
+            )
+        """)
+        cur.execute('DROP TABLE public.فهرس_الكيانات')
+        cur.execute('ALTER TABLE public.فهرس_الكيانات_جديد RENAME TO فهرس_الكيانات')
+        cur.execute('ALTER INDEX public.idx_فهرس_الكيانات_القيمة_جديد RENAME TO idx_فهرس_الكيانات_القيمة')
+        cur.execute('ALTER INDEX public.idx_فهرس_الكيانات_التقرير_جديد RENAME TO idx_فهرس_الكيانات_التقرير')
+        conn.commit()
+
+        cur.close()
+        conn.close()
+        return True
+
+    except Exception as e:
+        st.error(f"❌ فشل إعادة بناء فهرس الكيانات: {e}")
+        if conn:
+            conn.rollback()
+            conn.close()
+        return False
+
+
+def fetch_related_reports(search_value, max_depth=None, max_reports=1000):
+    """
+    يجلب التقارير المرتبطة برقم (هوية/جوال/سجل تجاري) عبر فهرس الكيانات.
+    max_depth=1 يُرجع التقارير التي تحتوي الرقم مباشرة، و None يُرجع المكوّن المترابط بالكامل
+    (التقارير المرتبطة بالتقارير المرتبطة... حتى max_reports).
+    يُرجع (records, column_names, links) حيث links قائمة (نوع الكيان، القيمة، عدد التقارير).
+    """
+    seed_values = []
+    for key in ENTITY_INDEX_COLUMNS:
+        for number in normalize_entity_numbers(key, search_value):
+            if number not in seed_values:
+                seed_values.append(number)
+    if not seed_values:
+        return [], DB_COLUMN_NAMES, []
+
+    conn = connect_db()
+    if not conn:
+        return None, None, None
+
+    try:
+        cur = conn.cursor()
+
+        # البحث بالعرض (BFS) على الفهرس: قيم ← تقارير ← قيم جديدة ...
+        cur.execute(
+            'SELECT DISTINCT "نوع الكيان", "القيمة" FROM public.فهرس_الكيانات WHERE "القيمة" = ANY(%s)',
+            [seed_values]
+        )
+        frontier_keys = set(cur.fetchall())
+        seen_keys = set(frontier_keys)
+        report_ids = set()
+        depth = 0
+
+        while frontier_keys and len(report_ids) < max_reports and (max_depth is None or depth < max_depth):
+            key_types, key_values = zip(*frontier_keys)
+            cur.execute(
+                """
+                SELECT DISTINCT "معرف التقرير" FROM public.فهرس_الكيانات
+                WHERE ("نوع الكيان", "القيمة") IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+                """,
+                [list(key_types), list(key_values)]
+            )
+            new_ids = {row[0] for row in cur.fetchall()} - report_ids
+            new_ids = set(list(new_ids)[:max_reports - len(report_ids)])
+            report_ids |= new_ids
+            depth += 1
+            if not new_ids or (max_depth is not None and depth >= max_depth):
+                break
+
+            cur.execute(
+                'SELECT DISTINCT "نوع الكيان", "القيمة" FROM public.فهرس_الكيانات WHERE "معرف التقرير" = ANY(%s)',
+                [list(new_ids)]
+            )
+            frontier_keys = set(cur.fetchall()) - seen_keys
+            seen_keys |= frontier_keys
+
+        if not report_ids:
+            cur.close()
+            conn.close()
+            return [], DB_COLUMN_NAMES, []
+
+        column_names = ["معرف التقرير"] + DB_COLUMN_NAMES
+        cur.execute(
+            sql.SQL('SELECT {columns} FROM public.تقارير_الاشتباه WHERE "معرف التقرير" = ANY(%s) ORDER BY "معرف التقرير"').format(
+                columns=sql.SQL(', ').join(sql.Identifier(col) for col in column_names)
+            ),
+            [list(report_ids)]
+        )
+        records = cur.fetchall()
+
+        # القيم التي تربط أكثر من تقرير داخل المجموعة
+        cur.execute(
+            """
+            SELECT "نوع الكيان", "القيمة", COUNT(DISTINCT "معرف التقرير") AS عدد_التقارير
+            FROM public.فهرس_الكيانات
+            WHERE "معرف التقرير" = ANY(%s)
+            GROUP BY "نوع الكيان", "القيمة"
+            HAVING COUNT(DISTINCT "معرف التقرير") > 1
+            ORDER BY عدد_التقارير DESC
+            """,
+            [list(report_ids)]
+        )
+        links = cur.fetchall()
+
+        cur.close()
+        conn.close()
+        return records, column_names, links
+
+    except Exception as e:
+        st.error(f"❌ حدث خطأ أثناء جلب التقارير المرتبطة: {e}")
+        if conn:
+            conn.close()
+        return None, None, None